@@ -0,0 +1,86 @@
+"""
+Benchmark of the lambda@edge event serialization and payload parsing.
+
+Compares building and serializing the whole event with json.dumps with
+dumps_event(), using the stdlib json module and orjson when installed,
+for a small request and a request with 100 headers.
+
+    python bench/bench_events.py
+"""
+import json
+
+from common import load_addon, timeit
+
+lep = load_addon()
+
+
+def make_request(header_count):
+    headers = {"host": [{"key": "Host", "value": "example.com"}]}
+    for i in range(header_count):
+        headers[f"x-trace-{i}"] = [{"key": f"X-Trace-{i}", "value": f"value-{i}" * 4}]
+    return {
+        "clientIp": "127.0.0.1",
+        "headers": headers,
+        "method": "GET",
+        "querystring": "a=1&b=2",
+        "uri": "/index.html",
+        "body": {
+            "inputTruncated": False,
+            "action": "read-only",
+            "encoding": "base64",
+            "data": lep.encode_body(b"data=123" * 16, 40 * 1024)[0],
+        },
+    }
+
+
+def dumps_whole(request):
+    """Serialize the way request_to_lambda used to"""
+    request = dict(request, body=dict(request["body"]))
+    request["body"]["data"] = str(request["body"]["data"], "utf-8")
+    return json.dumps(
+        {
+            "Records": [
+                {
+                    "cf": {
+                        "config": {
+                            "distributionDomainName": "dummy.cloudfront.net",
+                            "distributionId": "DUMMYIDEXAMPLE",
+                            "eventType": "viewer-request",
+                            "requestId": "IsThisReallyNeeded",
+                        },
+                        "request": request,
+                    }
+                }
+            ]
+        }
+    ).encode()
+
+
+def main():
+    backends = [("json", None)]
+    if lep.orjson:
+        backends.append(("orjson", lep.orjson))
+    orjson = lep.orjson
+    print(f"{'request':>12} {'method':>20} {'events/s':>10} {'parse/s':>10}")
+    for (name, header_count) in (("small", 2), ("100 headers", 100)):
+        request = make_request(header_count)
+        payload = dumps_whole(request)
+        assert json.loads(lep.dumps_event("viewer-request", request)) == json.loads(
+            payload
+        )
+        us = timeit(lambda: dumps_whole(request), 2000)
+        parse = timeit(lambda: json.loads(payload), 2000)
+        print(
+            f"{name:>12} {'json.dumps (whole)':>20} {1e6 / us:>10.0f} {1e6 / parse:>10.0f}"
+        )
+        for (backend, module) in backends:
+            lep.orjson = module
+            us = timeit(lambda: lep.dumps_event("viewer-request", request), 2000)
+            parse = timeit(lambda: lep.json_loads(payload), 2000)
+            method = f"dumps_event {backend}"
+            print(f"{name:>12} {method:>20} {1e6 / us:>10.0f} {1e6 / parse:>10.0f}")
+    lep.orjson = orjson
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Micro-benchmark of the header translation for requests with many headers.
+
+Measures get_headers() and set_headers() for requests carrying 10 to 100
+headers, as is common with cookies and tracing headers. set_headers()
+gets a payload with a few headers added, modified and removed.
+
+    python bench/bench_headers.py
+"""
+from mitmproxy.test import taddons, tflow
+
+from common import load_addon, timeit
+
+lep = load_addon()
+
+
+def make_flow(count):
+    flow = tflow.tflow()
+    for i in range(count):
+        flow.request.headers[f"X-Trace-{i}"] = f"value-{i}" * 4
+    return flow
+
+
+def make_payload(addon, flow):
+    headers = addon.get_headers(flow)
+    headers["x-trace-0"] = [{"key": "X-Trace-0", "value": "modified"}]
+    headers["x-trace-1"] = [{"value": "modified"}]
+    headers["x-added"] = [{"key": "X-Added", "value": "added"}]
+    del headers["x-trace-2"]
+    return {"headers": headers}
+
+
+def main():
+    addon = lep.LambdaEdgeLocalProxy()
+    with taddons.context(addon):
+        print(f"{'headers':>10} {'get':>10} {'set':>10}  (us)")
+        for count in (10, 50, 100):
+            flow = make_flow(count)
+            original = flow.request.headers.copy()
+            payload = make_payload(addon, flow)
+
+            def set_headers():
+                flow.request.headers = original.copy()
+                addon.set_headers(flow, payload)
+
+            set_headers()
+            assert flow.response is None
+            get = timeit(lambda: addon.get_headers(flow), 2000)
+            set_ = timeit(set_headers, 2000)
+            print(f"{count:>10} {get:>10.2f} {set_:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Load test of the proxy add-on against the stub Lambda endpoint.
+
+Drives LambdaEdgeLocalProxy with synthetic mitmproxy flows at a target
+rate, through the request and response hooks, with a StubLambda serving
+the functions of the template. The default scenarios are the requests of
+test.sh; --replay replays the requests of a mitmproxy flow file instead.
+Reports the throughput and p50/p99/p999 latency of each code path.
+Latencies are measured from the scheduled start of each request, so a
+stalled proxy shows up in the percentiles.
+
+    python bench/bench_proxy.py --rps 500 --duration 10 --latency 2
+    python bench/bench_proxy.py --replay flows.mitm --rps 100
+    python bench/bench_proxy.py --set lambda_at_edge_cache_size=1000000
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from mitmproxy import http, io
+from mitmproxy.test import taddons, tflow
+
+from common import ROOT, load_addon
+from stub_lambda import StubLambda
+
+lep = load_addon()
+
+# name -> (method, path, body), from test.sh
+SCENARIOS = {
+    "success": ("GET", "/Success/", b""),
+    "modheader": ("GET", "/ModHeader/?p=KV", b""),
+    "modbody": ("POST", "/ModBody/", b"data=123"),
+    "respond": ("GET", "/Respond/", b""),
+    "moduri": ("GET", "/ModUri/", b""),
+    "empty-return": ("GET", "/Failure/?p=EMPTY_RETURN", b""),
+    "header-no-value": ("GET", "/Failure/?p=HEADER_NO_VALUE", b""),
+    "exception": ("GET", "/Failure/?p=EXCEPTION", b""),
+    "malformed": ("GET", "/Failure/?p=MALFORMED", b""),
+    "timeout": ("GET", "/Failure/?p=TIMEOUT", b""),
+}
+
+
+def make_flow(method, path, body, request=None):
+    flow = tflow.tflow(req=request or True)
+    if request is None:
+        flow.request.method = method
+        flow.request.path = path
+        flow.request.content = body
+    # Set by the proxy server on real connections
+    flow.client_conn.ip_address = ("127.0.0.1", 50000)
+    flow.reply = None
+    return flow
+
+
+def load_requests(path):
+    """Read the requests (and responses) of a mitmproxy flow file"""
+    with open(path, "rb") as f:
+        return [
+            (flow.request, flow.response)
+            for flow in io.FlowReader(f).stream()
+            if isinstance(flow, http.HTTPFlow)
+        ]
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_flow(addon, flow, origin_response):
+    """Run a flow through the add-on, with the origin responding"""
+    await addon.process_request(flow)
+    if flow.response is None:
+        flow.response = origin_response.copy()
+        state = addon.flow_states.pop(flow, None)
+        if state is not None:
+            await addon.process_response(flow, state)
+    else:
+        addon.flow_states.pop(flow, None)
+
+
+async def warm_up(addon, requests, count):
+    """Run count requests one by one, creating clients and connections"""
+    for i in range(count):
+        (_, flow, origin_response) = requests(i)
+        await run_flow(addon, flow, origin_response)
+
+
+async def generate(addon, requests, rps, duration):
+    """Send requests round-robin at rps requests per second.
+    Returns: dict of code path -> (latencies, errors), and the elapsed time
+    """
+    results = {}
+    tasks = []
+
+    async def one(label, flow, origin_response, scheduled):
+        await run_flow(addon, flow, origin_response)
+        latency = time.perf_counter() - scheduled
+        if label is None:
+            route = addon.find_route(addon.get_uri(flow))
+            pattern = route.pattern if route else "no route"
+            label = f"{flow.request.method} {pattern} {flow.response.status_code}"
+        (latencies, errors) = results.setdefault(label, ([], [0]))
+        latencies.append(latency)
+        if flow.response.status_code >= 500:
+            errors[0] += 1
+
+    count = int(rps * duration)
+    start = time.perf_counter()
+    for i in range(count):
+        scheduled = start + i / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        (label, flow, origin_response) = requests(i)
+        tasks.append(
+            asyncio.ensure_future(one(label, flow, origin_response, scheduled))
+        )
+    await asyncio.gather(*tasks)
+    return (results, time.perf_counter() - start)
+
+
+def report(results, elapsed):
+    print(
+        f"{'code path':<32} {'requests':>9} {'rps':>8} {'errors':>7} "
+        + f"{'p50':>9} {'p99':>9} {'p999':>9}  (ms)"
+    )
+    total = 0
+    for (label, (latencies, errors)) in sorted(results.items()):
+        latencies.sort()
+        total += len(latencies)
+        print(
+            f"{label:<32} {len(latencies):>9} {len(latencies) / elapsed:>8.1f} "
+            + f"{errors[0]:>7} "
+            + " ".join(
+                f"{percentile(latencies, q) * 1000:>9.2f}" for q in (0.5, 0.99, 0.999)
+            )
+        )
+    print(f"{'total':<32} {total:>9} {total / elapsed:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "-t",
+        "--template",
+        default=os.path.join(ROOT, "test", "template-simple.yaml"),
+    )
+    parser.add_argument("--rps", type=float, default=200)
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="scenarios to run, all but timeout by default",
+    )
+    parser.add_argument("--replay", help="mitmproxy flow file to replay")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="stub function latency in ms"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0, help="stub function jitter in ms"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="add-on option, e.g. lambda_at_edge_max_concurrency=50",
+    )
+    args = parser.parse_args()
+    # The stub endpoint is unsigned, but botocore still needs a region
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+    origin_response = http.HTTPResponse.make(
+        200, b"origin" * 100, {"Content-Type": "text/plain"}
+    )
+    if args.replay:
+        recorded = load_requests(args.replay)
+        if not recorded:
+            parser.error(f"no HTTP flows in {args.replay}")
+
+        def requests(i):
+            (request, response) = recorded[i % len(recorded)]
+            flow = make_flow(None, None, None, request.copy())
+            return (None, flow, response or origin_response)
+
+        distinct = len(recorded)
+
+    else:
+        names = args.scenario or [name for name in SCENARIOS if name != "timeout"]
+
+        def requests(i):
+            name = names[i % len(names)]
+            return (name, make_flow(*SCENARIOS[name]), origin_response)
+
+        distinct = len(names)
+
+    stub = StubLambda(
+        args.template, latency=args.latency / 1000, jitter=args.jitter / 1000
+    ).start()
+    addon = lep.LambdaEdgeLocalProxy()
+    try:
+        with taddons.context(addon) as tctx:
+            tctx.configure(
+                addon,
+                lambda_at_edge_cf_template=args.template,
+                lambda_at_edge_endpoint=stub.url,
+                lambda_at_edge_watch_interval=0,
+            )
+            if args.set:
+                tctx.options.set(*args.set)
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(warm_up(addon, requests, distinct))
+            (results, elapsed) = loop.run_until_complete(
+                generate(addon, requests, args.rps, args.duration)
+            )
+            addon.done()
+    finally:
+        stub.stop()
+    report(results, elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Micro-benchmark of the CloudFront cache behavior lookup.
+
+Compares the precompiled RouteTable with the previous linear fnmatch scan
+as the number of CacheBehaviors grows.
+
+    python bench/bench_routes.py
+"""
+import fnmatch
+
+from common import load_addon, timeit
+
+lep = load_addon()
+
+
+def linear_lookup(patterns, uri):
+    for pattern in patterns:
+        if fnmatch.fnmatchcase(uri, pattern):
+            return pattern
+    return None
+
+
+def main():
+    print(f"{'behaviors':>10} {'fnmatch':>10} {'trie':>10} {'memoized':>10}  (us)")
+    for count in (10, 50, 100, 200, 500):
+        patterns = [f"/section{i}/*" for i in range(count)] + ["*"]
+        routes = [lep.Route(p) for p in patterns]
+        table = lep.RouteTable(routes)
+        # A URI served by the last behavior is the worst case for both
+        uri = f"/section{count - 1}/index.html"
+        assert table.lookup(uri).pattern == linear_lookup(patterns, uri)
+        linear = timeit(lambda: linear_lookup(patterns, uri), 2000)
+        trie = timeit(lambda: table._lookup(uri), 2000)
+        memoized = timeit(lambda: table.lookup(uri), 2000)
+        print(f"{count:>10} {linear:>10.2f} {trie:>10.2f} {memoized:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+import importlib.util
+import os
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_addon():
+    """Import lambda-edge-proxy.py, which is not a valid module name"""
+    spec = importlib.util.spec_from_file_location(
+        "lambda_edge_proxy", os.path.join(ROOT, "lambda-edge-proxy.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def timeit(func, number):
+    """Run func number times and return the mean time per call in microseconds"""
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number * 1e6
@@ -0,0 +1,238 @@
+"""
+Stub Lambda endpoint for benchmarks, without Docker or sam local.
+
+Serves the Lambda Invoke API for the functions of a template, running
+Python ports of the handlers of test/src/lambda_at_edge.js. Like the
+Failure function of the tests, ?p=... selects an error case:
+EMPTY_RETURN, TIMEOUT, HEADER_NO_VALUE, HEADER_KV_MISMATCH, EXCEPTION,
+and MALFORMED for a non-JSON payload. Every invocation can be delayed to
+emulate the function latency.
+
+    python bench/stub_lambda.py -t test/template-simple.yaml -p 3001 --latency 5
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode
+
+from cfn_tools import load_yaml
+
+from common import ROOT
+
+INVOKE_PATH = re.compile(r"^/2015-03-31/functions/([^/]+)/invocations")
+
+
+class FunctionError(Exception):
+    """An exception thrown by a handler: Unhandled FunctionError"""
+
+
+class FunctionTimeout(Exception):
+    """A handler running until the function Timeout"""
+
+
+def get_params(request):
+    return {k: v[0] for (k, v) in parse_qs(request["querystring"]).items()}
+
+
+def failure(event):
+    request = event["Records"][0]["cf"]["request"]
+    p = get_params(request).get("p")
+    if p == "EMPTY_RETURN":
+        return {}
+    if p == "TIMEOUT":
+        raise FunctionTimeout()
+    if p == "HEADER_NO_VALUE":
+        return {"headers": {"no-value": [{"VaLuE": "wrong"}]}}
+    if p == "HEADER_KV_MISMATCH":
+        return {"headers": {"key1": [{"key": "key2", "value": "value3"}]}}
+    if p == "EXCEPTION":
+        raise FunctionError("Exception in Lambda @ Edge Fuction")
+    if p == "MALFORMED":
+        return b"not a JSON payload"
+    return None
+
+
+def modheader(event):
+    request = event["Records"][0]["cf"]["request"]
+    params = get_params(request)
+    k = params.get("K", "user-agent")
+    v = params.get("V", "Changed_by_lambda_at_Edge")
+    request["headers"][k] = [{"value": v}]
+    if params.get("p") == "KV":
+        request["headers"][k] = [{"key": k, "value": v}]
+    elif params.get("p") == "DEL":
+        del request["headers"][k]
+    return request
+
+
+def modbody(event):
+    request = event["Records"][0]["cf"]["request"]
+    if request["method"] == "POST":
+        body = base64.b64decode(request["body"]["data"]).decode()
+        params = {k: v[0] for (k, v) in parse_qs(body).items()}
+        params["NewParam"] = "Body_changed_by_Lambda@Edge"
+        request["body"]["action"] = "replace"
+        data = urlencode(params)
+        if "p" in params:
+            request["body"]["encoding"] = params["p"]
+            request["body"]["data"] = base64.b64encode(data.encode()).decode()
+        else:
+            request["body"]["encoding"] = "text"
+            request["body"]["data"] = data
+    return request
+
+
+def respond(event):
+    return {
+        "body": '{"message":"Served_by_Lambda@Edge"}',
+        "bodyEncoding": "text",
+        "headers": {
+            "content-type": [{"value": "application/json"}],
+            "x-lambda-handler": [{"value": "Header added by Lambda@Edge"}],
+        },
+        "status": 202,
+        "statusDescription": "Accepted Allright",
+    }
+
+
+def moduri(event):
+    request = event["Records"][0]["cf"]["request"]
+    request["uri"] = get_params(request).get(
+        "p", "/Request_URI_Modified_by_Lambda@Edge"
+    )
+    return request
+
+
+def success(event):
+    return event["Records"][0]["cf"]["request"]
+
+
+def success_response(event):
+    return event["Records"][0]["cf"]["response"]
+
+
+# handler function name (after the last "." of Handler) -> handler
+HANDLERS = {
+    "failure": failure,
+    "modheader": modheader,
+    "modbody": modbody,
+    "respond": respond,
+    "moduri": moduri,
+    "success": success,
+    "success_response": success_response,
+}
+
+
+class StubLambdaHandler(BaseHTTPRequestHandler):
+    """Lambda Invoke API, with keep-alive connections like the real one"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes: avoid the Nagle/delayed ACK stall
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        event = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        match = INVOKE_PATH.match(self.path)
+        handler = match and self.server.handlers.get(match.group(1))
+        if handler is None:
+            self.reply(404, b'{"Type":"User","Message":"Function not found"}')
+            return
+        latency = self.server.latency + random.uniform(0, self.server.jitter)
+        if latency > 0:
+            time.sleep(latency)
+        try:
+            payload = handler(event)
+        except FunctionTimeout:
+            time.sleep(self.server.timeout)
+            msg = f"Task timed out after {self.server.timeout:.2f} seconds"
+            self.reply(200, msg.encode())
+            return
+        except FunctionError as e:
+            error = {"errorType": "Error", "errorMessage": str(e), "trace": []}
+            self.reply(200, json.dumps(error).encode(), {"Unhandled"})
+            return
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        self.reply(200, payload)
+
+    def reply(self, status, body, function_error=()):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for error in function_error:
+            self.send_header("X-Amz-Function-Error", error)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLambda(ThreadingHTTPServer):
+    """Stub Lambda endpoint for the functions of a template.
+    latency and jitter are in seconds, timeout is how long TIMEOUT cases run.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, template, port=0, latency=0, jitter=0, timeout=0.5):
+        super().__init__(("127.0.0.1", port), StubLambdaHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.timeout = timeout
+        self.handlers = {}
+        with open(template, "r") as f:
+            resources = load_yaml(f.read())["Resources"]
+        for (name, resource) in resources.items():
+            handler = resource.get("Properties", {}).get("Handler")
+            if isinstance(handler, str):
+                func = HANDLERS.get(handler.rpartition(".")[2])
+                if func:
+                    self.handlers[name] = func
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "-t",
+        "--template",
+        default=os.path.join(ROOT, "test", "template-simple.yaml"),
+    )
+    parser.add_argument("-p", "--port", type=int, default=3001)
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0, help="milliseconds")
+    parser.add_argument(
+        "--timeout", type=float, default=0.5, help="seconds of TIMEOUT cases"
+    )
+    args = parser.parse_args()
+    server = StubLambda(
+        args.template,
+        args.port,
+        args.latency / 1000,
+        args.jitter / 1000,
+        args.timeout,
+    )
+    print(f"Stub Lambda on {server.url}: {', '.join(server.handlers)}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
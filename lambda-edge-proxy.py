@@ -21,15 +21,34 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 
-Emulate Lambda@Edge Viewer Request events.
+Emulate Lambda@Edge viewer/origin request and response events.
 """
-import base64
-import fnmatch
+import asyncio
+import binascii
+import cProfile
+import functools
+import importlib
 import json
+import os
+import pickle
+import pstats
+import random
+import re
+import select
+import subprocess
+import sys
+import threading
+import time
 import traceback
+import tracemalloc
 import typing
-from collections import defaultdict
+import uuid
+import weakref
+from collections import OrderedDict, defaultdict, deque
 from collections.abc import Set
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
 
 import boto3
 import botocore
@@ -38,7 +57,12 @@ import yaml
 from cfn_tools import load_yaml
 from mitmproxy import ctx, http
 
-FORBIDDEN_HEADERS = [
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FORBIDDEN_HEADER_PATTERNS = [
     "connection",
     "expect",
     "keep-alive",
@@ -51,7 +75,7 @@ FORBIDDEN_HEADERS = [
     "x-accel-charset",
     "x-accel-limit-rate",
     "x-accel-redirect",
-    "x-amz-cf-*",  # TODO
+    "x-amz-cf-*",
     "x-amzn-auth",
     "x-amzn-cf-billing",
     "x-amzn-cf-id",
@@ -62,16 +86,410 @@ FORBIDDEN_HEADERS = [
     "x-amzn-lambda-integration-tag",
     "x-amzn-request-id",
     "x-cache",
-    "x-edge-*",  # TODO
+    "x-edge-*",
     "x-forwarded-proto",
     "x-real-ip",
 ]
-READONLY_HEADERS_VIEWER_REQUESTS = [
-    "content-length",
-    "host",
-    "transfer-encoding",
-    "via",
-]
+# Compiled once: exact names and the prefixes of the * patterns
+FORBIDDEN_HEADERS = frozenset(h for h in FORBIDDEN_HEADER_PATTERNS if "*" not in h)
+FORBIDDEN_HEADER_PREFIXES = tuple(
+    h[:-1] for h in FORBIDDEN_HEADER_PATTERNS if h.endswith("*")
+)
+READONLY_HEADERS_VIEWER_REQUESTS = frozenset(
+    [
+        "content-length",
+        "host",
+        "transfer-encoding",
+        "via",
+    ]
+)
+READONLY_HEADERS_ORIGIN_RESPONSES = frozenset(
+    [
+        "transfer-encoding",
+        "via",
+    ]
+)
+READONLY_HEADERS_VIEWER_RESPONSES = frozenset(
+    [
+        "content-encoding",
+        "content-length",
+        "transfer-encoding",
+        "warning",
+        "via",
+    ]
+)
+READONLY_HEADERS = {
+    "viewer-request": READONLY_HEADERS_VIEWER_REQUESTS,
+    "origin-request": READONLY_HEADERS_VIEWER_REQUESTS,
+    "origin-response": READONLY_HEADERS_ORIGIN_RESPONSES,
+    "viewer-response": READONLY_HEADERS_VIEWER_RESPONSES,
+}
+SUPPORTED_EVENT_TYPES = list(READONLY_HEADERS)
+# CloudFront truncates the body exposed with IncludeBody
+BODY_SIZE_LIMITS = {
+    "viewer-request": 40 * 1024,
+    "origin-request": 1024 * 1024,
+    "origin-response": 1024 * 1024,
+    "viewer-response": 40 * 1024,
+}
+# Lambda@Edge quotas, applied with lambda_at_edge_emulate_limits: function
+# timeout in seconds, memory in MB and size of the generated response
+EVENT_TIMEOUT_LIMITS = {
+    "viewer-request": 5,
+    "origin-request": 30,
+    "origin-response": 30,
+    "viewer-response": 5,
+}
+EVENT_MEMORY_LIMITS = {
+    "viewer-request": 128,
+    "origin-request": 10240,
+    "origin-response": 10240,
+    "viewer-response": 128,
+}
+RESPONSE_SIZE_LIMITS = {
+    "viewer-request": 40 * 1024,
+    "origin-request": 1024 * 1024,
+    "origin-response": 1024 * 1024,
+    "viewer-response": 40 * 1024,
+}
+EDGE_RUNTIMES = ("nodejs", "python")
+# Upper bounds in seconds of the latency histogram buckets
+METRICS_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+# Added to a function Timeout for its read timeout, to allow for cold starts
+FUNCTION_TIMEOUT_MARGIN = 5
+BODY_PLACEHOLDER = "\0lambda-at-edge-body\0"
+BODY_PLACEHOLDER_JSON = json.dumps(BODY_PLACEHOLDER).encode()
+EVENT_CONFIGS = {
+    event_type: {
+        "distributionDomainName": "dummy.cloudfront.net",
+        "distributionId": "DUMMYIDEXAMPLE",
+        "eventType": event_type,
+        "requestId": "IsThisReallyNeeded",
+    }
+    for event_type in SUPPORTED_EVENT_TYPES
+}
+# The static part of lambda@edge events: everything but the request (and
+# response) of each event type, serialized once
+EVENT_PREFIXES = {
+    event_type: b'{"Records":[{"cf":{"config":'
+    + json.dumps(config, separators=(",", ":")).encode()
+    + b',"request":'
+    for (event_type, config) in EVENT_CONFIGS.items()
+}
+EVENT_SUFFIX = b"}}]}"
+ROUTE_CACHE_SIZE = 4096
+# Lambda defaults
+DEFAULT_FUNCTION_TIMEOUT = 3
+DEFAULT_FUNCTION_MEMORY = 128
+# Synthetic request and response of the prewarm events
+PREWARM_REQUEST = {
+    "clientIp": "127.0.0.1",
+    "headers": {"host": [{"key": "Host", "value": "localhost"}]},
+    "method": "GET",
+    "querystring": "",
+    "uri": "/",
+}
+PREWARM_RESPONSE = {"status": "200", "statusDescription": "OK", "headers": {}}
+# Access log levels, from the most verbose
+ACCESS_LOG_LEVELS = ("debug", "info", "error")
+ACCESS_LOG_FLUSH_INTERVAL = 1
+# Records buffered before the access log is flushed early
+ACCESS_LOG_BUFFER = 1000
+# Invocation errors opening the circuit breakers: timeouts, FunctionErrors
+# and connection failures
+BREAKER_ERRORS = frozenset(
+    (
+        "status_code",
+        "non_json_payload",
+        "function_error",
+        "limit_timeout",
+        "ReadTimeoutError",
+        "ConnectTimeoutError",
+        "EndpointConnectionError",
+        "ConnectionRefusedError",
+    )
+)
+# Frames kept per allocation by tracemalloc profile captures
+PROFILE_TRACEMALLOC_FRAMES = 16
+# Command line argument running this script as a PythonWorker process
+PYTHON_WORKER_ARG = "--lambda-at-edge-python-worker"
+# Seconds between checks of the handler sources for changes
+PYTHON_RELOAD_INTERVAL = 1
+# Status codes CloudFront caches by default
+CACHEABLE_STATUS_CODES = [200, 203, 300, 301, 410]
+# Managed cache policies: id -> (MinTTL, DefaultTTL, MaxTTL)
+MANAGED_CACHE_POLICIES = {
+    "658327ea-f89d-4fab-a63d-7e88639e58f6": (1, 86400, 31536000),  # Optimized
+    "b2884449-e4de-46a7-ac36-70bc7f1ddd6d": (1, 86400, 31536000),  # Uncompressed
+    "4135ea2d-6df8-44a3-9df3-4b5a84be39ad": (0, 0, 0),  # CachingDisabled
+}
+
+
+def is_forbidden_header(name):
+    """Check a lowercase header name against the forbidden headers"""
+    return name in FORBIDDEN_HEADERS or name.startswith(FORBIDDEN_HEADER_PREFIXES)
+
+
+def decode_header(value: bytes) -> str:
+    """Decode a raw header name or value as mitmproxy does"""
+    return value.decode("utf-8", "surrogateescape")
+
+
+def encode_header(value: str) -> bytes:
+    """Encode a header name or value as mitmproxy does"""
+    return value.encode("utf-8", "surrogateescape")
+
+
+def encode_body(content: bytes, limit):
+    """Base64 encode at most limit bytes of a body, without copying the input.
+    Returns: (base64 bytes, input truncated)
+    """
+    view = memoryview(content)
+    return (binascii.b2a_base64(view[:limit], newline=False), len(view) > limit)
+
+
+def decode_body(data, encoding) -> typing.Optional[bytes]:
+    """Decode a lambda@edge body, or None for an unknown encoding.
+    Raises ValueError (binascii.Error) for malformed base64.
+    """
+    if encoding == "base64":
+        return binascii.a2b_base64(data)
+    if encoding == "text":
+        return data.encode("utf-8")
+    return None
+
+
+def json_dumps(obj, default=None) -> bytes:
+    """Serialize to compact JSON, with orjson if it is installed.
+    orjson refuses lone surrogates, as in surrogateescape'd headers: json
+    escapes them instead.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, default=default)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, default=default, separators=(",", ":")).encode()
+
+
+def json_loads(data):
+    """Parse JSON, with orjson if it is installed.
+    orjson.JSONDecodeError is a json.decoder.JSONDecodeError. orjson also
+    refuses escaped lone surrogates, which json_dumps() sends: json
+    parses them instead.
+    """
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def dump_spliced(obj, chunks):
+    """Append the JSON of obj to chunks.
+    bytes values (base64 bodies from encode_body) are spliced into the
+    output as JSON strings, so they are copied once instead of going
+    through str and the JSON encoder.
+    """
+    bodies = []
+
+    def default(o):
+        if isinstance(o, bytes):
+            bodies.append(o)
+            return BODY_PLACEHOLDER
+        raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+    data = json_dumps(obj, default)
+    # After an orjson failure, the bodies of the json retry are the last ones
+    del bodies[: len(bodies) - data.count(BODY_PLACEHOLDER_JSON)]
+    if not bodies:
+        chunks.append(data)
+        return
+    parts = data.split(BODY_PLACEHOLDER_JSON)
+    if len(parts) != len(bodies) + 1:
+        raise ValueError("Lambda@Edge: body placeholder found in event")
+    chunks.append(parts[0])
+    for (body, part) in zip(bodies, parts[1:]):
+        chunks += (b'"', body, b'"', part)
+
+
+def dumps_event(event_type, request, response=None) -> bytes:
+    """Serialize a lambda@edge event to JSON.
+    Only the request and response are serialized, into the precomputed
+    EVENT_PREFIXES of the event type.
+    """
+    chunks = [EVENT_PREFIXES[event_type]]
+    dump_spliced(request, chunks)
+    if response is not None:
+        chunks.append(b',"response":')
+        dump_spliced(response, chunks)
+    chunks.append(EVENT_SUFFIX)
+    return b"".join(chunks)
+
+
+def make_event(event_type, request, response=None):
+    """Build a lambda@edge event as a dict, for handlers run in-process.
+    The base64 bytes bodies of encode_body() are decoded to str.
+    """
+
+    def decode(message):
+        body = message.get("body")
+        if body and isinstance(body.get("data"), bytes):
+            message = dict(message, body=dict(body, data=body["data"].decode()))
+        return message
+
+    cf = {"config": dict(EVENT_CONFIGS[event_type]), "request": decode(request)}
+    if response is not None:
+        cf["response"] = decode(response)
+    return {"Records": [{"cf": cf}]}
+
+
+def parse_function_headers(specs):
+    """Parse FunctionName[=header,header...] options.
+    Returns: dict of function name -> frozenset of lowercase header names,
+    or None for all the headers
+    """
+    functions = {}
+    for spec in specs:
+        (func_name, sep, headers) = spec.partition("=")
+        functions[func_name.strip()] = (
+            frozenset(h.strip().lower() for h in headers.split(",") if h.strip())
+            if sep
+            else None
+        )
+    return functions
+
+
+def result_key(event_type, request, headers=None):
+    """Canonical, hashable key of a *-request event, for the ResultCache and
+    coalescing.
+    With a set of lowercase header names, only those headers are part of
+    the key, and the client IP is not.
+    """
+    key_headers = tuple(
+        sorted(
+            (name, tuple(h["value"] for h in values))
+            for (name, values) in request["headers"].items()
+            if headers is None or name in headers
+        )
+    )
+    body = request["body"]
+    return (
+        event_type,
+        None if headers is not None else request["clientIp"],
+        request["method"],
+        request["uri"],
+        request["querystring"],
+        key_headers,
+        body["inputTruncated"],
+        body["data"],
+    )
+
+
+def request_change(request, payload):
+    """The change a *-request function made to its event, to replay on other
+    requests with the same result key with apply_request_change().
+    Headers are diffed, so that headers left out of the key (cookies,
+    credentials) are never copied from one request to another. The other
+    fields of the payload are part of the key, and a generated response does
+    not depend on the request headers.
+    Returns: (payload without headers, changed headers, removed header names)
+    """
+    headers = payload.get("headers")
+    if "status" in payload or not isinstance(headers, dict):
+        return (payload, None, None)
+    old_headers = request["headers"]
+    changed = {}
+    for (name, values) in headers.items():
+        key = name.lower() if isinstance(name, str) else name
+        if old_headers.get(key) != values:
+            changed[name] = values
+    new_keys = {name.lower() for name in headers if isinstance(name, str)}
+    removed = frozenset(key for key in old_headers if key not in new_keys)
+    rest = {k: v for (k, v) in payload.items() if k != "headers"}
+    return (rest, changed, removed)
+
+
+def apply_request_change(request, change):
+    """Apply a request_change() to the event of another request.
+    Returns: the payload the function would have returned for it
+    """
+    (payload, changed, removed) = change
+    if changed is None:
+        return payload
+    headers = {k: v for (k, v) in request["headers"].items() if k not in removed}
+    for (name, values) in changed.items():
+        # request headers are keyed by lowercase name
+        headers.pop(name.lower() if isinstance(name, str) else name, None)
+        headers[name] = values
+    return dict(payload, headers=headers)
+
+
+def read_template(path):
+    """Parse a template file. Does not use ctx, so it can run in a thread.
+    Returns: (file stat, template data)
+    """
+    stat = template_stat(path)
+    with open(path, "r") as f:
+        return (stat, load_yaml(f.read()))
+
+
+def template_stat(path):
+    """What changes when a template file is written"""
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def diff_routes(old_routes, new_routes):
+    """Describe the function association changes between two sets of routes.
+    Returns: list of log lines
+    """
+
+    def associations(routes):
+        return {
+            (route.pattern, event_type): func
+            for route in routes
+            for (event_type, func) in route.funcs.items()
+        }
+
+    def describe(func):
+        (func_name, include_body) = func
+        return func_name + (" (body)" if include_body else "")
+
+    old = associations(old_routes)
+    new = associations(new_routes)
+    lines = []
+    for key in sorted(old.keys() | new.keys()):
+        if old.get(key) == new.get(key):
+            continue
+        (pattern, event_type) = key
+        if key not in new:
+            change = f"removed {describe(old[key])}"
+        elif key not in old:
+            change = f"added {describe(new[key])}"
+        else:
+            change = f"{describe(old[key])} -> {describe(new[key])}"
+        lines.append(f"{pattern} {event_type}: {change}")
+    return lines
 
 
 def get_headers_capitalized(headers_in):
@@ -95,79 +513,1846 @@ def get_headers_capitalized(headers_in):
     return headers_out
 
 
-class LambdaEdgeLocalProxy:
-    def __init__(self):
-        self.endpoint = None
-        self.lambda_client = None
-        self.funcs = defaultdict(list)
+def translate_path_pattern(pattern):
+    """Translate a CloudFront PathPattern to a regular expression.
+    CloudFront only supports the * and ? wildcards.
+    """
+    return "".join(
+        ".*" if c == "*" else "." if c == "?" else re.escape(c) for c in pattern
+    )
+
+
+class Route:
+    """CloudFront cache behavior with its Lambda@Edge function associations"""
+
+    __slots__ = ("pattern", "funcs", "cache_policy")
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        # event type -> (function name, include body)
+        self.funcs = {}
+        self.cache_policy = CachePolicy()
+
+
+class CachePolicy:
+    """Cache key and TTL settings of a CloudFront cache behavior.
+    The defaults are those of a legacy behavior without ForwardedValues:
+    nothing but the URI is part of the cache key.
+    """
+
+    __slots__ = ("min_ttl", "default_ttl", "max_ttl", "query_strings", "headers")
+
+    def __init__(self, min_ttl=0, default_ttl=86400, max_ttl=31536000):
+        self.min_ttl = min_ttl
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        # (behavior, names): behavior is none, all, whitelist or allExcept
+        self.query_strings = ("none", frozenset())
+        self.headers = ()
+
+    @classmethod
+    def from_forwarded_values(cls, behavior):
+        """Build from a legacy cache behavior with ForwardedValues"""
+        policy = cls(
+            behavior.get("MinTTL", 0),
+            behavior.get("DefaultTTL", 86400),
+            behavior.get("MaxTTL", 31536000),
+        )
+        values = behavior["ForwardedValues"]
+        if str(values.get("QueryString", False)).lower() == "true":
+            if "QueryStringCacheKeys" in values:
+                names = frozenset(values["QueryStringCacheKeys"])
+                policy.query_strings = ("whitelist", names)
+            else:
+                policy.query_strings = ("all", frozenset())
+        headers = values.get("Headers", [])
+        if "*" in headers:
+            # Forwarding all headers disables caching
+            policy.max_ttl = 0
+        policy.headers = tuple(sorted(h.lower() for h in headers))
+        return policy
+
+    @classmethod
+    def from_config(cls, config):
+        """Build from a CachePolicyConfig"""
+        policy = cls(
+            config.get("MinTTL", 0),
+            config.get("DefaultTTL", 86400),
+            config.get("MaxTTL", 31536000),
+        )
+        params = config.get("ParametersInCacheKeyAndForwardedToOrigin", {})
+        qs_config = params.get("QueryStringsConfig", {})
+        policy.query_strings = (
+            qs_config.get("QueryStringBehavior", "none"),
+            frozenset(qs_config.get("QueryStrings", [])),
+        )
+        headers_config = params.get("HeadersConfig", {})
+        if headers_config.get("HeaderBehavior", "none") == "whitelist":
+            headers = headers_config.get("Headers", [])
+            policy.headers = tuple(sorted(h.lower() for h in headers))
+        return policy
+
+    def cache_key(self, flow, querystring):
+        """Build the cache key of a request, or None if it is not cacheable"""
+        if self.max_ttl <= 0 or flow.request.method != "GET":
+            return None
+        (behavior, names) = self.query_strings
+        if behavior == "none":
+            params = ()
+        else:
+            params = parse_qsl(querystring, keep_blank_values=True)
+            if behavior == "whitelist":
+                params = [p for p in params if p[0] in names]
+            elif behavior == "allExcept":
+                params = [p for p in params if p[0] not in names]
+            params = tuple(sorted(params))
+        headers = tuple(tuple(flow.request.headers.get_all(h)) for h in self.headers)
+        return (flow.request.path.split("?")[0], params, headers)
+
+    def ttl(self, response):
+        """Time to live of a response in seconds, following Cache-Control"""
+        directives = {}
+        for directive in response.headers.get("cache-control", "").split(","):
+            (name, _, value) = directive.strip().lower().partition("=")
+            directives[name] = value
+        if (
+            "no-store" in directives
+            or "no-cache" in directives
+            or "private" in directives
+        ):
+            return self.min_ttl
+        for name in ("s-maxage", "max-age"):
+            if name in directives:
+                try:
+                    ttl = int(directives[name])
+                except ValueError:
+                    continue
+                return max(self.min_ttl, min(ttl, self.max_ttl))
+        return min(self.default_ttl, self.max_ttl)
+
+
+class EdgeCache:
+    """In-memory CloudFront edge cache with LRU eviction and a byte budget"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # key -> (response, size, stored at, expires at)
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return (response, age in seconds) for a fresh entry, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[3] <= now:
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return (entry[0], int(now - entry[2]))
+
+    def put(self, key, response, ttl):
+        """Store a copy of a response for ttl seconds"""
+        if key in self.entries:
+            self.remove(key)
+        size = len(response.raw_content or b"") + sum(
+            len(k) + len(v) for (k, v) in response.headers.fields
+        )
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        now = time.monotonic()
+        self.entries[key] = (response.copy(), size, now, now + ttl)
+        self.size += size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key)[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+class ResultCache:
+    """Memoized function results (request_change() of their payloads) with
+    LRU eviction and a TTL
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (result, expires at)
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return a fresh result, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, result):
+        """Store a result, which must not be modified afterwards"""
+        self.entries.pop(key, None)
+        self.entries[key] = (result, time.monotonic() + self.ttl)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class Histogram:
+    """Latency histogram with METRICS_BUCKETS buckets"""
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        # The last bucket counts values above all bounds (+Inf)
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(METRICS_BUCKETS) and value > METRICS_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of its bucket"""
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts[:-1]):
+            seen += count
+            if seen >= rank:
+                return METRICS_BUCKETS[i]
+        return float("inf")
+
+
+class Metrics:
+    """Thread-safe histograms and counters, keyed by name and labels.
+    Labels are tuples of (name, value) pairs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        # functions returning (name, labels, value) gauges, called on render
+        self.gauges = []
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def render(self):
+        """Render in the Prometheus text exposition format"""
+
+        def format_labels(labels):
+            return ",".join(
+                k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+                for (k, v) in labels
+            )
+
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            typed = set()
+            for ((name, labels), histogram) in histograms:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                bounds = [str(b) for b in METRICS_BUCKETS] + ["+Inf"]
+                for (bound, count) in zip(bounds, histogram.counts):
+                    cumulative += count
+                    le = format_labels(labels + (("le", bound),))
+                    lines.append(f"{name}_bucket{{{le}}} {cumulative}")
+                lines.append(f"{name}_sum{{{format_labels(labels)}}} {histogram.sum}")
+                lines.append(
+                    f"{name}_count{{{format_labels(labels)}}} {histogram.count}"
+                )
+            for ((name, labels), value) in counters:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{{{format_labels(labels)}}} {value}")
+            for gauges in self.gauges:
+                for (name, labels, value) in sorted(gauges()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name}{{{format_labels(labels)}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Summarize the stage latencies per function and event type.
+        Returns: list of log lines
+        """
+        stages = defaultdict(list)
+        with self.lock:
+            for ((name, labels), histogram) in sorted(self.histograms.items()):
+                if name != "lambda_at_edge_stage_seconds" or not histogram.count:
+                    continue
+                labels = dict(labels)
+                stages[(labels["function"], labels["event_type"])].append(
+                    f"{labels['stage']} "
+                    + f"p50={histogram.quantile(0.5) * 1000:g}ms "
+                    + f"p99={histogram.quantile(0.99) * 1000:g}ms"
+                )
+        return [
+            f"Lambda@Edge: {func_name} {event_type}: " + ", ".join(values)
+            for ((func_name, event_type), values) in stages.items()
+        ]
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve Metrics.render() on /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LambdaClients:
+    """boto3 Lambda clients of an endpoint, one per read timeout.
+    botocore clients are thread-safe and each keeps a pool of keep-alive
+    connections, so they are shared by all the invocation threads.
+    """
+
+    def __init__(
+        self, endpoint, pool_size, connect_timeout, read_timeout, tcp_keepalive
+    ):
+        self.endpoint = endpoint
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.tcp_keepalive = tcp_keepalive
+        # boto3 sessions are not thread-safe, clients are
+        self.session = boto3.session.Session()
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get(self, read_timeout=None):
+        """Get the client for a read timeout, by default the endpoint one"""
+        if read_timeout is None:
+            read_timeout = self.read_timeout
+        client = self.clients.get(read_timeout)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(read_timeout)
+                if client is None:
+                    client = self.clients[read_timeout] = self.create(read_timeout)
+        return client
+
+    def create(self, read_timeout):
+        options = {
+            "signature_version": botocore.UNSIGNED,
+            "connect_timeout": self.connect_timeout,
+            "read_timeout": read_timeout,
+            "max_pool_connections": self.pool_size,
+            "retries": {"max_attempts": 0},
+        }
+        try:
+            config = botocore.config.Config(tcp_keepalive=self.tcp_keepalive, **options)
+        except TypeError:
+            # tcp_keepalive needs botocore >= 1.27
+            config = botocore.config.Config(**options)
+        return self.session.client(
+            "lambda",
+            endpoint_url=self.endpoint,
+            use_ssl=False,
+            verify=False,
+            config=config,
+        )
+
+
+class Endpoint:
+    """A Lambda endpoint, with its in-flight invocations and ejection time"""
+
+    __slots__ = ("url", "clients", "outstanding", "ejected_until")
+
+    def __init__(self, url, clients):
+        self.url = url
+        self.clients = clients
+        self.outstanding = 0
+        self.ejected_until = 0
+
+
+class EndpointPool:
+    """Balance invocations across Lambda endpoints.
+    Picks the healthy endpoint with the least outstanding invocations
+    (ties and the round-robin mode rotate through the endpoints), and
+    ejects endpoints that refuse connections for a while.
+    """
+
+    def __init__(
+        self, endpoints, balancing="least_outstanding", eject_seconds=10, lock=None
+    ):
+        self.endpoints = endpoints
+        self.balancing = balancing
+        self.eject_seconds = eject_seconds
+        # shared by the pools of the same endpoints
+        self.lock = lock or threading.Lock()
+        self.next = 0
+
+    def acquire(self, exclude=()):
+        """Pick an endpoint and count the invocation as outstanding.
+        Ejected endpoints are only used when all of them are ejected.
+        Returns: Endpoint, or None if all the endpoints are excluded
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if e.ejected_until <= now]
+            if not healthy:
+                healthy = [min(candidates, key=lambda e: e.ejected_until)]
+            start = self.next % len(healthy)
+            self.next += 1
+            rotated = healthy[start:] + healthy[:start]
+            if self.balancing == "round_robin":
+                endpoint = rotated[0]
+            else:
+                endpoint = min(rotated, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+
+    def eject(self, endpoint):
+        with self.lock:
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+
+
+class PythonContext:
+    """The context argument of Python Lambda handlers"""
+
+    def __init__(self, function_name, memory_limit_in_mb, timeout):
+        self.function_name = function_name
+        self.function_version = "$LATEST"
+        self.invoked_function_arn = (
+            f"arn:aws:lambda:us-east-1:123456789012:function:{function_name}"
+        )
+        self.memory_limit_in_mb = memory_limit_in_mb
+        self.aws_request_id = str(uuid.uuid4())
+        self.log_group_name = f"/aws/lambda/us-east-1.{function_name}"
+        self.log_stream_name = "$LATEST"
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class PythonHandlers:
+    """Python handlers imported in a PythonWorker process.
+    Modules are imported from the CodeUri of the function. They are
+    unloaded when another CodeUri is used, as modules of different
+    functions often have the same names, and reloaded when their source
+    files change.
+    """
+
+    def __init__(self):
+        self.code_dir = None
+        self.handlers = {}
+        # source file -> mtime, of the modules imported from code_dir
+        self.sources = {}
+        self.checked = 0
+
+    def get(self, code_dir, handler):
+        if code_dir != self.code_dir or self.changed():
+            self.unload()
+            self.code_dir = code_dir
+            sys.path.insert(0, code_dir)
+        func = self.handlers.get(handler)
+        if func is None:
+            (module_name, _, func_name) = handler.replace("/", ".").rpartition(".")
+            module = importlib.import_module(module_name)
+            func = self.handlers[handler] = getattr(module, func_name)
+            self.track()
+        return func
+
+    def modules(self):
+        """Modules imported from code_dir: name -> source file"""
+        prefix = os.path.join(self.code_dir, "")
+        return {
+            name: module.__file__
+            for (name, module) in list(sys.modules.items())
+            if (getattr(module, "__file__", None) or "").startswith(prefix)
+        }
+
+    def track(self):
+        for path in self.modules().values():
+            if path not in self.sources:
+                self.sources[path] = os.stat(path).st_mtime
+
+    def changed(self):
+        now = time.monotonic()
+        if not self.code_dir or now - self.checked < PYTHON_RELOAD_INTERVAL:
+            return False
+        self.checked = now
+        self.track()
+        for (path, mtime) in self.sources.items():
+            try:
+                if os.stat(path).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def unload(self):
+        if self.code_dir is None:
+            return
+        for name in self.modules():
+            del sys.modules[name]
+        if self.code_dir in sys.path:
+            sys.path.remove(self.code_dir)
+        importlib.invalidate_caches()
+        self.code_dir = None
+        self.handlers = {}
+        self.sources = {}
+
+
+def python_worker():
+    """Main loop of a PythonWorker process.
+    Reads pickled (code_dir, handler, event, context arguments) from stdin
+    and writes pickled (function error, payload) results to stdout.
+    """
+    stdin = os.fdopen(os.dup(0), "rb")
+    stdout = os.fdopen(os.dup(1), "wb")
+    # Keep handler prints and reads off the pipes
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(2, 1)
+    handlers = PythonHandlers()
+    while True:
+        try:
+            (code_dir, handler, event, context) = pickle.load(stdin)
+        except EOFError:
+            return
+        try:
+            func = handlers.get(code_dir, handler)
+            result = pickle.dumps((None, func(event, PythonContext(*context))))
+        except Exception as e:
+            traceback.print_exc()
+            error = {
+                "errorMessage": str(e),
+                "errorType": type(e).__name__,
+                "stackTrace": traceback.format_tb(e.__traceback__),
+            }
+            result = pickle.dumps(("Unhandled", error))
+        stdout.write(result)
+        stdout.flush()
+
+
+class PythonWorker:
+    """A process running Python handlers, see python_worker()"""
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), PYTHON_WORKER_ARG],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def call(self, code_dir, handler, event, context, timeout):
+        """Run a handler.
+        Raises TimeoutError if it does not return within timeout seconds.
+        Returns: (function error, payload)
+        """
+        pickle.dump((code_dir, handler, event, context), self.process.stdin)
+        self.process.stdin.flush()
+        (ready, _, _) = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            raise TimeoutError()
+        return pickle.load(self.process.stdout)
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class PythonWorkers:
+    """A pool of warm PythonWorker processes.
+    A worker runs one handler at a time, like a Lambda container, and is
+    killed when a handler times out or the worker dies.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # Notified when a worker is released or can be created
+        self.cond = threading.Condition()
+        self.created = 0
+        # LIFO, to reuse the warmest workers
+        self.idle = []
+        self.closed = False
+
+    def acquire(self):
+        """Get an idle worker, or start one while under size.
+        Raises RuntimeError once the pool is closed, also in waiting threads.
+        """
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("Python workers closed")
+                if self.idle:
+                    return self.idle.pop()
+                if self.created < self.size:
+                    self.created += 1
+                    break
+                self.cond.wait()
+        try:
+            return PythonWorker()
+        except Exception:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, worker, healthy=True):
+        with self.cond:
+            if healthy and not self.closed:
+                self.idle.append(worker)
+                self.cond.notify()
+                return
+            # A waiter can create a new worker instead
+            self.created -= 1
+            self.cond.notify()
+        worker.kill()
+
+    def call(self, code_dir, handler, event, context, timeout):
+        """Run a handler on a worker, see PythonWorker.call()"""
+        worker = self.acquire()
+        healthy = False
+        try:
+            result = worker.call(code_dir, handler, event, context, timeout)
+            healthy = True
+            return result
+        finally:
+            self.release(worker, healthy)
+
+    def close(self):
+        """Kill the idle workers, and the busy ones once released"""
+        with self.cond:
+            self.closed = True
+            (idle, self.idle) = (self.idle, [])
+            self.created -= len(idle)
+            self.cond.notify_all()
+        for worker in idle:
+            worker.kill()
+
+
+class FunctionLimiter:
+    """Concurrency and token bucket rate limits of a function.
+    Used on the event loop only. Invocations over a limit wait in FIFO
+    order, for a bounded time.
+    """
+
+    def __init__(self, concurrency=None, rate=None, burst=None):
+        # None for no limit
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst or max(1, rate or 0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.active = 0
+        # [future to wake the waiter] of the queued invocations
+        self.waiters = deque()
+
+    def take(self):
+        """Start an invocation if no limit is reached.
+        Returns: None if started, else the reached limit
+        """
+        if self.concurrency is not None and self.active >= self.concurrency:
+            return "concurrency"
+        if self.rate is not None:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < 1:
+                return "rate"
+            self.tokens -= 1
+        self.active += 1
+        return None
+
+    async def acquire(self, timeout):
+        """Start an invocation, waiting up to timeout seconds.
+        Returns: None if started, else the reached limit
+        """
+        if not self.waiters:
+            reason = self.take()
+            if reason is None or timeout <= 0:
+                return reason
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        waiter = [None]
+        self.waiters.append(waiter)
+        try:
+            while True:
+                reason = self.take() if self.waiters[0] is waiter else "concurrency"
+                if reason is None:
+                    return None
+                delay = deadline - loop.time()
+                if delay <= 0:
+                    return reason
+                if reason == "rate" and self.rate:
+                    # Retry when the next token is due
+                    delay = min(delay, (1 - self.tokens) / self.rate)
+                waiter[0] = loop.create_future()
+                try:
+                    await asyncio.wait_for(waiter[0], delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiters.remove(waiter)
+            self.wake()
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        """Let the first waiter try again"""
+        if self.waiters:
+            future = self.waiters[0][0]
+            if future is not None and not future.done():
+                future.set_result(None)
+
+
+class CircuitBreaker:
+    """Fail fast for a function failing again and again.
+    Used on the event loop only. Opens after threshold consecutive failures;
+    once open for open_seconds, lets up to probes invocations through
+    (half-open): a successful probe closes it, a failed one opens it again.
+    """
+
+    def __init__(self, threshold, open_seconds, probes):
+        self.threshold = threshold
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self.failures = 0
+        # time.monotonic() of the opening, None while closed
+        self.opened = None
+        self.probing = 0
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if time.monotonic() - self.opened < self.open_seconds:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        """Start an invocation if not open.
+        Returns: "closed" or "probe" if started, else None
+        """
+        state = self.state
+        if state == "closed":
+            return state
+        if state == "half_open" and self.probing < self.probes:
+            self.probing += 1
+            return "probe"
+        return None
+
+    def record(self, token, failed):
+        """End an invocation started by allow(), None failed for no verdict.
+        Returns: the new state if it changed, else None
+        """
+        if token == "probe":
+            self.probing -= 1
+        if failed is None:
+            return None
+        if failed:
+            self.failures += 1
+            if token == "probe" or (
+                self.opened is None and self.failures >= self.threshold
+            ):
+                self.opened = time.monotonic()
+                return "open"
+        elif token == "probe" or self.opened is None:
+            self.failures = 0
+            if self.opened is not None:
+                self.opened = None
+                return "closed"
+        return None
+
+
+class Containers:
+    """Emulated execution environments of the functions, telling cold from
+    warm invocations. Used on the event loop only: an invocation is warm when
+    it finds an environment left idle by a previous one, cold otherwise.
+    """
+
+    def __init__(self):
+        # function name -> idle environments
+        self.idle = defaultdict(int)
+
+    def acquire(self, func_name):
+        """Returns: cold or warm"""
+        if self.idle[func_name] > 0:
+            self.idle[func_name] -= 1
+            return "warm"
+        return "cold"
+
+    def release(self, func_name):
+        self.idle[func_name] += 1
+
+    def clear(self):
+        self.idle.clear()
+
+
+class Invocation:
+    """One lambda@edge function call, timing each of its stages"""
+
+    __slots__ = (
+        "func_name",
+        "event_type",
+        "metrics",
+        "labels",
+        "started",
+        "last",
+        "outcome",
+        "failure",
+        "start",
+    )
+
+    def __init__(self, metrics, func_name, event_type):
+        self.func_name = func_name
+        self.event_type = event_type
+        self.metrics = metrics
+        self.labels = (("function", func_name), ("event_type", event_type))
+        self.started = self.last = time.perf_counter()
+        # For the access log: ok, generated, memoized, coalesced, bypassed
+        # or error
+        self.outcome = "ok"
+        # Error name, of an error outcome
+        self.failure = None
+        # cold or warm, once the function is invoked
+        self.start = None
+
+    def mark(self, stage, now=None):
+        """Record the time spent since the previous stage"""
+        if now is None:
+            now = time.perf_counter()
+        labels = self.labels + (("stage", stage),)
+        self.metrics.observe("lambda_at_edge_stage_seconds", labels, now - self.last)
+        self.last = now
+
+    def memo(self, result):
+        """Count a ResultCache hit or miss"""
+        if result == "hit":
+            self.outcome = "memoized"
+        self.metrics.inc(
+            "lambda_at_edge_memoize_total", self.labels + (("result", result),)
+        )
+
+    def coalesced(self):
+        """Count an invocation skipped for one in flight"""
+        self.outcome = "coalesced"
+        self.metrics.inc("lambda_at_edge_coalesced_total", self.labels)
+
+    def error(self, error, status_code):
+        self.outcome = "error"
+        self.failure = error
+        labels = self.labels + (("error", error), ("status", str(status_code)))
+        self.metrics.inc("lambda_at_edge_errors_total", labels)
+
+
+class ProfileCapture:
+    """cProfile and tracemalloc capture of a request function of a flow.
+    Both are process-wide: whatever else runs meanwhile on the event loop
+    shows up in the capture too, so only one capture runs at a time.
+    """
+
+    def __init__(self, flow, cpu, memory):
+        self.flow = flow
+        # cProfile.Profile of the event loop, then of the invocation threads
+        self.profiles = []
+        self.snapshot = None
+        self.tracing = memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        self.profile = self.enable() if cpu else None
+        self.memory = memory
+
+    def enable(self):
+        """Profile the calling thread.
+        Returns: the cProfile.Profile, None if another profiler is active
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12 profiles all threads with one profiler
+            return None
+        self.profiles.append(profile)
+        return profile
+
+    def wrap(self, func):
+        """Profile func in the invocation thread running it too"""
+
+        def profiled(*args):
+            profile = self.enable() if self.profile else None
+            try:
+                return func(*args)
+            finally:
+                if profile:
+                    profile.disable()
+
+        return profiled
+
+    def finish(self):
+        if self.profile:
+            self.profile.disable()
+        if self.memory:
+            self.snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__),)
+            )
+        if self.tracing:
+            tracemalloc.stop()
+
+    def write(self, prefix):
+        """Write the capture as prefix.prof (pstats, for snakeviz, flameprof or
+        gprof2dot) and prefix.tracemalloc (tracemalloc.Snapshot.load()).
+        Returns: the written paths
+        """
+        paths = []
+        if self.profiles:
+            stats = pstats.Stats(self.profiles[0])
+            for profile in self.profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(prefix + ".prof")
+            paths.append(prefix + ".prof")
+        if self.snapshot:
+            self.snapshot.dump(prefix + ".tracemalloc")
+            paths.append(prefix + ".tracemalloc")
+        return paths
+
+
+class AccessRecord:
+    """Access log record of a flow.
+    Only raw values are collected while the flow is processed, the
+    AccessLog thread turns them into JSON.
+    """
+
+    __slots__ = (
+        "time",
+        "started",
+        "method",
+        "uri",
+        "route",
+        "invocations",
+        "changes",
+        "status",
+        "seconds",
+        "level",
+        "error",
+        "sampled",
+    )
+
+    def __init__(self, flow, route, sampled):
+        self.time = time.time()
+        self.started = time.perf_counter()
+        self.method = flow.request.method
+        self.uri = flow.request.path
+        self.route = route.pattern
+        self.invocations = []
+        # dicts describing each change made by the functions
+        self.changes = []
+        self.status = None
+        self.seconds = None
+        self.level = None
+        # Error message of a flow failing without response, like an
+        # unreachable origin
+        self.error = None
+        # Flows left out by sampling are only logged on errors
+        self.sampled = sampled
+
+    def finish(self, flow):
+        """Set the outcome of the flow.
+        Returns: level of the record, None if left out by sampling
+        """
+        self.seconds = time.perf_counter() - self.started
+        self.status = flow.response.status_code if flow.response else None
+        self.error = flow.error.msg if flow.error else None
+        if (
+            self.error
+            or (self.status is not None and self.status >= 500)
+            or any(invocation.outcome == "error" for invocation in self.invocations)
+        ):
+            self.level = "error"
+        elif self.changes:
+            self.level = "info"
+        else:
+            self.level = "debug"
+        if not self.sampled and self.level != "error":
+            return None
+        return self.level
+
+    def to_dict(self):
+        return {
+            "time": self.time,
+            "level": self.level,
+            "method": self.method,
+            "uri": self.uri,
+            "route": self.route,
+            "status": self.status,
+            "seconds": self.seconds,
+            "error": self.error,
+            "invocations": [
+                {
+                    "function": invocation.func_name,
+                    "event_type": invocation.event_type,
+                    "outcome": invocation.outcome,
+                    "start": invocation.start,
+                    "seconds": invocation.last - invocation.started,
+                }
+                for invocation in self.invocations
+            ],
+            "changes": self.changes,
+        }
+
+
+class AccessLog:
+    """JSON lines access log, written in bulk by a background thread"""
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        self.lock = threading.Lock()
+        self.records = []
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self.run, name="lambda-at-edge-access-log", daemon=True
+        )
+        self.thread.start()
+
+    def write(self, record):
+        with self.lock:
+            self.records.append(record)
+            if len(self.records) >= ACCESS_LOG_BUFFER:
+                self.wakeup.set()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(ACCESS_LOG_FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            (records, self.records) = (self.records, [])
+        if records:
+            self.file.write(
+                b"".join(json_dumps(record.to_dict()) + b"\n" for record in records)
+            )
+            self.file.flush()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+class FlowState:
+    """Lambda@Edge state of a flow, kept from the request to the response hook"""
+
+    __slots__ = ("route", "events", "cache_miss", "cache_key")
+
+    def __init__(self, route):
+        self.route = route
+        # Response event types to run
+        self.events = ()
+        self.cache_miss = False
+        self.cache_key = None
+
+
+class RouteTable:
+    """Precompiled CloudFront cache behaviors.
+    The literal prefix of each path pattern (up to its first wildcard) is
+    stored in a trie, so a lookup only tries the regexes of the behaviors
+    whose prefix matches the URI, in CloudFront order: the first matching
+    behavior wins. Lookups are memoized per URI.
+    """
+
+    def __init__(self, routes=()):
+        self.routes = tuple(routes)
+        self.regexes = []
+        # char -> child node, "" -> indices of routes ending at this node
+        self.trie = {"": []}
+        for (i, route) in enumerate(self.routes):
+            pattern = route.pattern
+            if not pattern.startswith(("/", "*")):
+                # CloudFront treats "images/*" as "/images/*"
+                pattern = "/" + pattern
+            regex = translate_path_pattern(pattern)
+            self.regexes.append(re.compile(regex, re.DOTALL))
+            node = self.trie
+            for c in re.split(r"[*?]", pattern, 1)[0]:
+                node = node.setdefault(c, {"": []})
+            node[""].append(i)
+        self.lookup = functools.lru_cache(maxsize=ROUTE_CACHE_SIZE)(self._lookup)
+
+    def _lookup(self, uri) -> typing.Optional[Route]:
+        node = self.trie
+        candidates = list(node[""])
+        for c in uri:
+            node = node.get(c)
+            if node is None:
+                break
+            candidates.extend(node[""])
+        for i in sorted(candidates):
+            if self.regexes[i].fullmatch(uri):
+                return self.routes[i]
+        return None
+
+    def __len__(self):
+        return len(self.routes)
+
+
+def defer_hook(flow, coro):
+    """Run coro as a hook without blocking mitmproxy's event loop.
+    The flow reply is taken and only committed once the coroutine is done.
+    """
+    flow.reply.take()
+
+    def commit(task):
+        if flow.reply.state != "taken":
+            # Killed meanwhile, which committed the reply
+            return
+        if not task.cancelled() and task.exception():
+            e = task.exception()
+            msg = f"Lambda@Edge: Exception: {repr(e)}"
+            ctx.log.error(msg)
+            traceback.print_exception(type(e), e, e.__traceback__)
+            # Fail closed: never let the flow through half processed
+            flow.response = http.HTTPResponse.make(502, msg)
+        if not flow.reply.has_message:
+            flow.reply.ack()
+        flow.reply.commit()
+
+    asyncio.ensure_future(coro).add_done_callback(commit)
+
+
+def flow_killed(flow):
+    """Whether a flow was killed, e.g. from the mitmproxy UI, while its
+    functions ran: their results must not be applied
+    """
+    return flow.reply is not None and flow.reply.state == "committed"
+
+
+class LambdaEdgeLocalProxy:
+    def __init__(self):
+        self.endpoint = None
+        self.endpoints = None
+        # function name -> EndpointPool, for lambda_at_edge_function_endpoints
+        self.function_endpoints = {}
+        # function name -> Properties, with the template Globals
+        self.functions = {}
+        # function name -> (code dir, handler), of the Python functions
+        self.python_handlers = {}
+        self.python_workers = None
+        self.executor = None
+        self.routes = RouteTable()
+        # template_stat() of the loaded template
+        self.template_stat = None
+        self.template_task = None
+        self.containers = Containers()
+        self.prewarm_task = None
+        self.cache = None
+        # function name -> headers of the result key (None for all), of the
+        # functions in lambda_at_edge_memoize
+        self.memoized = {}
+        self.results = None
+        # function name -> headers of the result key, of the functions in
+        # lambda_at_edge_coalesce
+        self.coalesced = {}
+        # result key -> future of (request_change() of the payload, error
+        # response), of the invocations in flight of coalesced functions
+        self.in_flight = {}
+        # flow -> FlowState of flows that may run response events
+        self.flow_states = weakref.WeakKeyDictionary()
+        self.access_log = None
+        # flow -> AccessRecord of the sampled flows
+        self.access_records = weakref.WeakKeyDictionary()
+        # Directory of the profile captures, None when profiling is disabled
+        self.profile_dir = None
+        # Flows sampled for profiling, and the capture running
+        self.profiled_flows = weakref.WeakSet()
+        self.profile_capture = None
+        self.metrics = Metrics()
+        # function name -> FunctionLimiter, of the functions with limits
+        self.limiters = {}
+        self.metrics.gauges.append(self.limiter_gauges)
+        # function name -> CircuitBreaker, created on the first invocation
+        # when lambda_at_edge_breaker_failures is set
+        self.breakers = {}
+        self.metrics.gauges.append(self.breaker_gauges)
+        self.metrics_server = None
+        self.metrics_task = None
+
+    def load(self, loader: mitm.addonmanager.Loader):
+        """Add loader options to mitmproxy.
+        This function is a mitmproxy hook.
+        """
+        loader.add_option(
+            name="lambda_at_edge_endpoint",
+            typespec=str,
+            default="http://127.0.0.1:3001",
+            help="Lambda@Edge Endpoint URLs, comma-separated",
+        )
+        loader.add_option(
+            name="lambda_at_edge_function_endpoints",
+            typespec=typing.Sequence[str],
+            default=[],
+            help="Lambda@Edge Endpoint URLs of a function, "
+            + "as FunctionName=URL[,URL...]",
+        )
+        loader.add_option(
+            name="lambda_at_edge_balancing",
+            typespec=str,
+            default="least_outstanding",
+            choices=["least_outstanding", "round_robin"],
+            help="Load balancing across Lambda@Edge endpoints",
+        )
+        loader.add_option(
+            name="lambda_at_edge_eject_seconds",
+            typespec=float,
+            default=10,
+            help="Seconds to stop using a Lambda@Edge endpoint "
+            + "refusing connections",
+        )
+        loader.add_option(
+            name="lambda_at_edge_cf_template",
+            typespec=str,
+            default="template.yaml",
+            help="Lambda@Edge CloudFormation Template",
+        )
+        loader.add_option(
+            name="lambda_at_edge_watch_interval",
+            typespec=float,
+            default=1,
+            help="Seconds between checks of the template file for changes, "
+            + "0 to disable reloading",
+        )
+        loader.add_option(
+            name="lambda_at_edge_max_concurrency",
+            typespec=int,
+            default=10,
+            help="Maximum number of Lambda@Edge invocations in flight",
+        )
+        loader.add_option(
+            name="lambda_at_edge_pool_size",
+            typespec=int,
+            default=0,
+            help="Lambda@Edge keep-alive connections per endpoint, "
+            + "0 for lambda_at_edge_max_concurrency",
+        )
+        loader.add_option(
+            name="lambda_at_edge_connect_timeout",
+            typespec=float,
+            default=5,
+            help="Lambda@Edge endpoint connect timeout in seconds",
+        )
+        loader.add_option(
+            name="lambda_at_edge_read_timeout",
+            typespec=float,
+            default=15,
+            help="Lambda@Edge endpoint read timeout in seconds",
+        )
+        loader.add_option(
+            name="lambda_at_edge_tcp_keepalive",
+            typespec=bool,
+            default=True,
+            help="Enable TCP keep-alive on Lambda@Edge endpoint connections",
+        )
+        loader.add_option(
+            name="lambda_at_edge_function_timeouts",
+            typespec=bool,
+            default=False,
+            help="Use the Timeout of each function in the template "
+            + f"(plus {FUNCTION_TIMEOUT_MARGIN}s) as its read timeout",
+        )
+        loader.add_option(
+            name="lambda_at_edge_emulate_limits",
+            typespec=bool,
+            default=False,
+            help="Apply the Lambda@Edge timeout and generated response size "
+            + "quotas of each event type, and warn about unsupported functions",
+        )
+        loader.add_option(
+            name="lambda_at_edge_prewarm",
+            typespec=int,
+            default=0,
+            help="Containers started per function with synthetic events "
+            + "after loading the template, 0 to disable",
+        )
+        loader.add_option(
+            name="lambda_at_edge_python_workers",
+            typespec=int,
+            default=0,
+            help="Worker processes running Python handlers in-process "
+            + "instead of invoking the endpoint, 0 to disable",
+        )
+        loader.add_option(
+            name="lambda_at_edge_concurrency_limits",
+            typespec=typing.Sequence[str],
+            default=[],
+            help="Concurrent invocations of a function, as FunctionName=N, "
+            + "instead of its ReservedConcurrentExecutions",
+        )
+        loader.add_option(
+            name="lambda_at_edge_rate_limits",
+            typespec=typing.Sequence[str],
+            default=[],
+            help="Invocations per second of a function, "
+            + "as FunctionName=RATE[:BURST]",
+        )
+        loader.add_option(
+            name="lambda_at_edge_throttle_wait",
+            typespec=float,
+            default=0,
+            help="Seconds invocations over a limit wait before being "
+            + "throttled with a 503, 0 to throttle them at once",
+        )
+        loader.add_option(
+            name="lambda_at_edge_breaker_failures",
+            typespec=int,
+            default=0,
+            help="Consecutive timeouts, FunctionErrors or connection failures "
+            + "opening the circuit breaker of a function, 0 to disable",
+        )
+        loader.add_option(
+            name="lambda_at_edge_breaker_open_seconds",
+            typespec=float,
+            default=30,
+            help="Seconds an open circuit breaker fails fast before letting "
+            + "probe invocations through",
+        )
+        loader.add_option(
+            name="lambda_at_edge_breaker_probes",
+            typespec=int,
+            default=1,
+            help="Concurrent probe invocations of a half-open circuit breaker",
+        )
+        loader.add_option(
+            name="lambda_at_edge_breaker_action",
+            typespec=str,
+            default="error",
+            choices=["error", "bypass"],
+            help="While a circuit breaker is open, respond with "
+            + "lambda_at_edge_breaker_status (error) or skip the function (bypass)",
+        )
+        loader.add_option(
+            name="lambda_at_edge_breaker_status",
+            typespec=int,
+            default=503,
+            help="Status code of the error response of an open circuit breaker",
+        )
+        loader.add_option(
+            name="lambda_at_edge_cache_size",
+            typespec=int,
+            default=0,
+            help="Edge cache size in bytes, 0 to disable the edge cache",
+        )
+        loader.add_option(
+            name="lambda_at_edge_memoize",
+            typespec=typing.Sequence[str],
+            default=[],
+            help="Functions whose request event results are cached, "
+            + "as FunctionName[=header,header...] to only key on some headers",
+        )
+        loader.add_option(
+            name="lambda_at_edge_memoize_size",
+            typespec=int,
+            default=10000,
+            help="Maximum number of cached function results",
+        )
+        loader.add_option(
+            name="lambda_at_edge_memoize_ttl",
+            typespec=float,
+            default=60,
+            help="Seconds to cache function results",
+        )
+        loader.add_option(
+            name="lambda_at_edge_coalesce",
+            typespec=typing.Sequence[str],
+            default=[],
+            help="Functions whose concurrent identical request events share "
+            + "one invocation, as FunctionName[=header,header...] to only "
+            + "compare some headers",
+        )
+        loader.add_option(
+            name="lambda_at_edge_access_log",
+            typespec=str,
+            default="",
+            help="JSON lines access log file of the flows running functions, "
+            + "empty to disable",
+        )
+        loader.add_option(
+            name="lambda_at_edge_access_log_level",
+            typespec=str,
+            default="info",
+            choices=list(ACCESS_LOG_LEVELS),
+            help="Access log level: debug for all the flows, info for flows "
+            + "changed by functions, error for errors only",
+        )
+        loader.add_option(
+            name="lambda_at_edge_access_log_sample",
+            typespec=float,
+            default=1,
+            help="Fraction of the flows in the access log, errors excepted",
+        )
+        loader.add_option(
+            name="lambda_at_edge_profile_dir",
+            typespec=str,
+            default="",
+            help="Directory of the profile captures of the request functions "
+            + "of sampled flows, empty to disable profiling",
+        )
+        loader.add_option(
+            name="lambda_at_edge_profile_mode",
+            typespec=str,
+            default="cpu",
+            choices=["cpu", "memory", "both"],
+            help="Capture a cProfile (cpu), a tracemalloc snapshot (memory) "
+            + "or both",
+        )
+        loader.add_option(
+            name="lambda_at_edge_profile_sample",
+            typespec=float,
+            default=0,
+            help="Fraction of the flows profiled",
+        )
+        loader.add_option(
+            name="lambda_at_edge_profile_header",
+            typespec=str,
+            default="X-Lambda-Edge-Profile",
+            help="Request header profiling a flow, removed from the request",
+        )
+        loader.add_option(
+            name="lambda_at_edge_metrics_port",
+            typespec=int,
+            default=0,
+            help="Port of the local Prometheus metrics endpoint, 0 to disable",
+        )
+        loader.add_option(
+            name="lambda_at_edge_metrics_interval",
+            typespec=float,
+            default=0,
+            help="Seconds between metrics summary logs, 0 to disable",
+        )
+
+    def configure(self, updates: Set[str]):
+        """Configure from mitmproxy options.
+        This function is a mitmproxy hook.
+        """
+        if "lambda_at_edge_max_concurrency" in updates:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+            self.executor = ThreadPoolExecutor(
+                max_workers=max(1, ctx.options.lambda_at_edge_max_concurrency),
+                thread_name_prefix="lambda-at-edge",
+            )
+        if updates & {
+            "lambda_at_edge_endpoint",
+            "lambda_at_edge_function_endpoints",
+            "lambda_at_edge_balancing",
+            "lambda_at_edge_eject_seconds",
+            "lambda_at_edge_max_concurrency",
+            "lambda_at_edge_pool_size",
+            "lambda_at_edge_connect_timeout",
+            "lambda_at_edge_read_timeout",
+            "lambda_at_edge_tcp_keepalive",
+        }:
+            self.endpoint = ctx.options.lambda_at_edge_endpoint
+            self.configure_endpoints()
+        if "lambda_at_edge_python_workers" in updates:
+            if self.python_workers:
+                self.python_workers.close()
+            size = ctx.options.lambda_at_edge_python_workers
+            self.python_workers = PythonWorkers(size) if size > 0 else None
+        if "lambda_at_edge_metrics_port" in updates:
+            self.stop_metrics_server()
+            port = ctx.options.lambda_at_edge_metrics_port
+            if port > 0:
+                try:
+                    self.metrics_server = ThreadingHTTPServer(
+                        ("127.0.0.1", port), MetricsHandler
+                    )
+                    self.metrics_server.daemon_threads = True
+                    self.metrics_server.metrics = self.metrics
+                    threading.Thread(
+                        target=self.metrics_server.serve_forever,
+                        name="lambda-at-edge-metrics",
+                        daemon=True,
+                    ).start()
+                    ctx.log.info(f"Lambda@Edge: metrics on http://127.0.0.1:{port}/")
+                except Exception as e:
+                    ctx.log.error(e)
+                    traceback.print_exc()
+        if "lambda_at_edge_access_log" in updates:
+            if self.access_log:
+                self.access_log.close()
+                self.access_log = None
+            path = ctx.options.lambda_at_edge_access_log
+            if path:
+                try:
+                    self.access_log = AccessLog(path)
+                except OSError as e:
+                    ctx.log.error(f"Lambda@Edge: access log: {e}")
+        if "lambda_at_edge_profile_dir" in updates:
+            self.profile_dir = None
+            path = ctx.options.lambda_at_edge_profile_dir
+            if path:
+                try:
+                    os.makedirs(path, exist_ok=True)
+                    self.profile_dir = path
+                except OSError as e:
+                    ctx.log.error(f"Lambda@Edge: profile directory: {e}")
+        if "lambda_at_edge_cache_size" in updates:
+            size = ctx.options.lambda_at_edge_cache_size
+            self.cache = EdgeCache(size) if size > 0 else None
+        if updates & {
+            "lambda_at_edge_memoize",
+            "lambda_at_edge_memoize_size",
+            "lambda_at_edge_memoize_ttl",
+        }:
+            self.memoized = parse_function_headers(ctx.options.lambda_at_edge_memoize)
+            self.results = (
+                ResultCache(
+                    ctx.options.lambda_at_edge_memoize_size,
+                    ctx.options.lambda_at_edge_memoize_ttl,
+                )
+                if self.memoized and ctx.options.lambda_at_edge_memoize_size > 0
+                else None
+            )
+        if "lambda_at_edge_coalesce" in updates:
+            self.coalesced = parse_function_headers(ctx.options.lambda_at_edge_coalesce)
+        if updates & {
+            "lambda_at_edge_concurrency_limits",
+            "lambda_at_edge_rate_limits",
+        }:
+            self.configure_limits()
+        if updates & {
+            "lambda_at_edge_breaker_failures",
+            "lambda_at_edge_breaker_open_seconds",
+            "lambda_at_edge_breaker_probes",
+        }:
+            self.breakers = {}
+        if "lambda_at_edge_cf_template" in updates:
+            path = ctx.options.lambda_at_edge_cf_template
+            try:
+                (self.template_stat, data) = read_template(path)
+                self.load_template(path, data)
+            except Exception as e:
+                ctx.log.error(e)
+                traceback.print_exc()
+        elif "lambda_at_edge_prewarm" in updates:
+            self.start_prewarm()
+
+    def load_template(self, path, data):
+        """Build the routes and functions of a parsed template, then swap them
+        in at once, logging the changed function associations.
+        Raises an exception for a malformed template, keeping the current ones.
+        """
+        found = None
+        routes = []
+        res = data["Resources"]
+        for k, v in res.items():
+            if v["Type"] == "AWS::CloudFront::Distribution":
+                if found:
+                    ctx.log.warn(
+                        f"Lambda@Edge: only first CloudFront Distribution "
+                        + f"'{found}' used from the template file"
+                    )
+                    break
+                found = k
+                dist_config = v["Properties"]["DistributionConfig"]
+                routes = self.populate_from_dist_config(res, dist_config)
+        if found is None:
+            raise ValueError(f"no CloudFront Distribution in '{path}'")
+        functions = self.get_functions(data, routes)
+        python_handlers = self.get_python_handlers(functions, os.path.dirname(path))
+        if self.routes.routes:
+            for line in diff_routes(self.routes.routes, routes):
+                ctx.log.info(f"Lambda@Edge: {line}")
+        # Hooks run on the event loop, so they see either the old or the new
+        # routes and functions, never a mix
+        self.functions = functions
+        self.python_handlers = python_handlers
+        self.routes = RouteTable(routes)
+        self.configure_limits()
+        if self.cache:
+            self.cache.clear()
+        if self.results:
+            self.results.clear()
+        if not any(route.funcs for route in routes):
+            ctx.log.error(
+                "Lambda@Edge: Could not find any "
+                + f"LambdaFunctionAssociations in '{found}'"
+            )
+        if ctx.options.lambda_at_edge_emulate_limits:
+            for line in self.check_limits():
+                ctx.log.warn(f"Lambda@Edge: {line}")
+        # Changed functions get new containers
+        self.containers.clear()
+        self.start_prewarm()
+
+    def get_event_types(self):
+        """Returns: dict of function name -> its associated event types"""
+        event_types = defaultdict(set)
+        for route in self.routes.routes:
+            for (event_type, (func_name, _)) in route.funcs.items():
+                event_types[func_name].add(event_type)
+        return event_types
+
+    def check_limits(self):
+        """Check the functions against the Lambda@Edge quotas.
+        Returns: list of warnings
+        """
+        warnings = []
+        for (func_name, event_types) in sorted(self.get_event_types().items()):
+            props = self.functions.get(func_name, {})
+            runtime = props.get("Runtime")
+            if isinstance(runtime, str) and not runtime.startswith(EDGE_RUNTIMES):
+                warnings.append(f"{func_name}: Runtime {runtime} not supported")
+            for (prop, limits) in (
+                ("Timeout", EVENT_TIMEOUT_LIMITS),
+                ("MemorySize", EVENT_MEMORY_LIMITS),
+            ):
+                value = props.get(prop)
+                if not isinstance(value, (int, float)):
+                    continue
+                for event_type in sorted(event_types):
+                    if value > limits[event_type]:
+                        warnings.append(
+                            f"{func_name}: {prop} {value} over the {event_type} "
+                            + f"limit of {limits[event_type]}"
+                        )
+        return warnings
+
+    def start_prewarm(self):
+        """Prewarm the functions in the background, instead of any prewarm
+        in progress
+        """
+        if self.prewarm_task:
+            self.prewarm_task.cancel()
+            self.prewarm_task = None
+        if ctx.options.lambda_at_edge_prewarm > 0:
+            self.prewarm_task = asyncio.ensure_future(self.prewarm())
+
+    async def prewarm(self):
+        """Invoke each associated function lambda_at_edge_prewarm times in
+        parallel with a synthetic event, to start its containers before the
+        first requests. The results do not matter, only the started containers.
+        """
+        count = ctx.options.lambda_at_edge_prewarm
+        loop = asyncio.get_event_loop()
+        started = time.perf_counter()
+
+        async def warm(func_name, event_type):
+            response = PREWARM_RESPONSE if event_type.endswith("-response") else None
+            (invoke, event) = self.get_invoke(
+                func_name, event_type, PREWARM_REQUEST, response
+            )
+            self.containers.acquire(func_name)
+            try:
+                (res, _, _) = await loop.run_in_executor(
+                    self.executor, invoke, func_name, event, event_type, True
+                )
+                return res["StatusCode"] == 200
+            except Exception:
+                return False
+            finally:
+                self.containers.release(func_name)
+
+        functions = {
+            func_name: min(event_types)
+            for (func_name, event_types) in self.get_event_types().items()
+        }
+        results = await asyncio.gather(
+            *(
+                warm(func_name, event_type)
+                for (func_name, event_type) in functions.items()
+                for _ in range(count)
+            )
+        )
+        ctx.log.info(
+            f"Lambda@Edge: prewarmed {count} containers of {len(functions)} "
+            + f"functions in {time.perf_counter() - started:.2f}s, "
+            + f"{results.count(False)} invocations failed"
+        )
+
+    def configure_limits(self):
+        """Build the limiters from the ReservedConcurrentExecutions of the
+        functions and the limit options
+        """
+        concurrency = {
+            func_name: props["ReservedConcurrentExecutions"]
+            for (func_name, props) in self.functions.items()
+            if isinstance(props.get("ReservedConcurrentExecutions"), int)
+        }
+        rates = {}
+        try:
+            for spec in ctx.options.lambda_at_edge_concurrency_limits:
+                (func_name, _, limit) = spec.partition("=")
+                concurrency[func_name.strip()] = int(limit)
+            for spec in ctx.options.lambda_at_edge_rate_limits:
+                (func_name, _, limit) = spec.partition("=")
+                (rate, _, burst) = limit.partition(":")
+                rates[func_name.strip()] = (float(rate), int(burst) if burst else None)
+        except ValueError as e:
+            ctx.log.error(f"Lambda@Edge: malformed limit: {e}")
+        self.limiters = {
+            func_name: FunctionLimiter(
+                concurrency.get(func_name), *rates.get(func_name, (None, None))
+            )
+            for func_name in concurrency.keys() | rates.keys()
+        }
+
+    def limiter_gauges(self):
+        """Queued and running invocations of the functions with limits.
+        Called by Metrics.render() on the metrics thread.
+        """
+        gauges = []
+        for (func_name, limiter) in list(self.limiters.items()):
+            labels = (("function", func_name),)
+            gauges.append(("lambda_at_edge_queued", labels, len(limiter.waiters)))
+            gauges.append(("lambda_at_edge_running", labels, limiter.active))
+        return gauges
+
+    def breaker_gauges(self):
+        """State of the circuit breakers: 0 closed, 1 open, 2 half-open.
+        Called by Metrics.render() on the metrics thread.
+        """
+        states = {"closed": 0, "open": 1, "half_open": 2}
+        return [
+            (
+                "lambda_at_edge_circuit_state",
+                (("function", func_name),),
+                states[b.state],
+            )
+            for (func_name, b) in list(self.breakers.items())
+        ]
+
+    def get_breaker(self, func_name):
+        """Returns: the CircuitBreaker of a function, None if disabled"""
+        threshold = ctx.options.lambda_at_edge_breaker_failures
+        if threshold <= 0:
+            return None
+        breaker = self.breakers.get(func_name)
+        if breaker is None:
+            breaker = self.breakers[func_name] = CircuitBreaker(
+                threshold,
+                ctx.options.lambda_at_edge_breaker_open_seconds,
+                ctx.options.lambda_at_edge_breaker_probes,
+            )
+        return breaker
+
+    def end_breaker(self, invocation: Invocation, breaker, token, failed):
+        """Record the result of an invocation on its circuit breaker"""
+        state = breaker.record(token, failed)
+        if state == "open":
+            ctx.log.warn(
+                f"Lambda@Edge: circuit breaker of {invocation.func_name} open "
+                + f"after {breaker.failures} failures"
+            )
+            self.metrics.inc(
+                "lambda_at_edge_circuit_opened_total",
+                (("function", invocation.func_name),),
+            )
+        elif state == "closed":
+            ctx.log.info(
+                f"Lambda@Edge: circuit breaker of {invocation.func_name} closed"
+            )
 
-    def load(self, loader: mitm.addonmanager.Loader):
-        """Add loader options to mitmproxy.
-        This function is a mitmproxy hook.
-        """
-        loader.add_option(
-            name="lambda_at_edge_endpoint",
-            typespec=str,
-            default="http://127.0.0.1:3001",
-            help="Lambda@Edge Endpoint URL",
-        )
-        loader.add_option(
-            name="lambda_at_edge_cf_template",
-            typespec=str,
-            default="template.yaml",
-            help="Lambda@Edge CloudFormation Template",
+    def configure_endpoints(self):
+        """Build the endpoint pools, sharing the clients of each URL"""
+        pool_size = (
+            ctx.options.lambda_at_edge_pool_size
+            or ctx.options.lambda_at_edge_max_concurrency
         )
+        endpoints = {}
+        lock = threading.Lock()
 
-    def configure(self, updates: Set[str]):
-        """Configure from mitmproxy options.
-        This function is a mitmproxy hook.
-        """
-        if "lambda_at_edge_endpoint" in updates:
-            self.endpoint = ctx.options.lambda_at_edge_endpoint
-            try:
-                self.lambda_client = boto3.client(
-                    "lambda",
-                    endpoint_url=ctx.options.lambda_at_edge_endpoint,
-                    use_ssl=False,
-                    verify=False,
-                    config=botocore.config.Config(
-                        signature_version=botocore.UNSIGNED,
-                        read_timeout=15,
-                        retries={"max_attempts": 0},
-                    ),
-                )
-            except Exception as e:
-                ctx.log.error(e)
-                traceback.print_exc(e)
-        if "lambda_at_edge_cf_template" in updates:
-            try:
-                text = open(ctx.options.lambda_at_edge_cf_template, "r").read()
-                data = load_yaml(text)
-                found = None
-                self.funcs = defaultdict(list)
-                res = data["Resources"]
-                for k, v in res.items():
-                    if v["Type"] == "AWS::CloudFront::Distribution":
-                        if found:
-                            ctx.log.warn(
-                                f"Lambda@Edge: only first CloudFront Distribution "
-                                + "'{found}' used from the template file"
-                            )
-                            return
-                        found = k
-                        dist_config = v["Properties"]["DistributionConfig"]
-                        self.populate_from_dist_config(res, dist_config)
-                if len(self.funcs) == 0:
-                    ctx.log.error(
-                        "Lambda@Edge: Could not find any "
-                        + "LambdaFunctionAssociations in '{found}'"
+        def pool(urls):
+            for url in urls:
+                if url not in endpoints:
+                    endpoints[url] = Endpoint(
+                        url,
+                        LambdaClients(
+                            url,
+                            max(1, pool_size),
+                            ctx.options.lambda_at_edge_connect_timeout,
+                            ctx.options.lambda_at_edge_read_timeout,
+                            ctx.options.lambda_at_edge_tcp_keepalive,
+                        ),
                     )
-            except Exception as e:
-                ctx.log.error(e)
-                traceback.print_exc(e)
+            return EndpointPool(
+                [endpoints[url] for url in urls],
+                ctx.options.lambda_at_edge_balancing,
+                ctx.options.lambda_at_edge_eject_seconds,
+                lock,
+            )
+
+        def split(urls):
+            return list(dict.fromkeys(u.strip() for u in urls.split(",") if u.strip()))
+
+        self.endpoints = pool(split(ctx.options.lambda_at_edge_endpoint))
+        self.function_endpoints = {}
+        for spec in ctx.options.lambda_at_edge_function_endpoints:
+            (func_name, _, urls) = spec.partition("=")
+            urls = split(urls)
+            if not func_name.strip() or not urls:
+                ctx.log.error(
+                    f"Lambda@Edge: malformed function endpoints '{spec}', "
+                    + "expected FunctionName=URL[,URL...]"
+                )
+                continue
+            self.function_endpoints[func_name.strip()] = pool(urls)
+        if not self.endpoints.endpoints:
+            ctx.log.error("Lambda@Edge: no endpoint in lambda_at_edge_endpoint")
 
     def populate_from_dist_config(self, resources, dist_config):
-        """populate from CloudFront DistributionConfig"""
+        """Build routes from CloudFront DistributionConfig.
+        Returns: list of routes in CloudFront precedence order
+        """
+        routes = []
         if "CacheBehaviors" in dist_config:
             behaviors = dist_config["CacheBehaviors"]
             for behavior in behaviors:
@@ -175,14 +2360,97 @@ class LambdaEdgeLocalProxy:
                 if not isinstance(path, str):
                     ctx.log.warn("Lambda@Edge: path functions not supported")
                     continue
+                route = Route(path)
+                route.cache_policy = self.get_cache_policy(resources, behavior)
                 if "LambdaFunctionAssociations" in behavior:
                     self.add_funcs(
-                        resources, path, behavior["LambdaFunctionAssociations"]
+                        resources, route, behavior["LambdaFunctionAssociations"]
                     )
+                routes.append(route)
         if "DefaultCacheBehavior" in dist_config:
             behavior = dist_config["DefaultCacheBehavior"]
+            route = Route("*")
+            route.cache_policy = self.get_cache_policy(resources, behavior)
             if "LambdaFunctionAssociations" in behavior:
-                self.add_funcs(resources, "*", behavior["LambdaFunctionAssociations"])
+                self.add_funcs(resources, route, behavior["LambdaFunctionAssociations"])
+            routes.append(route)
+        return routes
+
+    def get_functions(self, data, routes):
+        """Get the template Properties of the functions used by routes.
+        Properties missing from a function are taken from Globals.
+        Returns: dict of function name -> Properties
+        """
+        res = data["Resources"]
+        globals_ = data.get("Globals", {}).get("Function", {})
+        functions = {}
+        for route in routes:
+            for (func_name, _) in route.funcs.values():
+                props = dict(globals_)
+                if func_name in res:
+                    props.update(res[func_name].get("Properties", {}))
+                functions[func_name] = props
+        return functions
+
+    def get_python_handlers(self, functions, template_dir):
+        """Get the code directory and handler of the Python functions.
+        Returns: dict of function name -> (code dir, handler)
+        """
+        handlers = {}
+        for (func_name, props) in functions.items():
+            runtime = props.get("Runtime")
+            handler = props.get("Handler")
+            code_uri = props.get("CodeUri", ".")
+            if not (
+                isinstance(runtime, str)
+                and runtime.startswith("python")
+                and isinstance(handler, str)
+                and isinstance(code_uri, str)
+            ):
+                continue
+            code_dir = os.path.abspath(os.path.join(template_dir, code_uri))
+            handlers[func_name] = (code_dir, handler)
+        return handlers
+
+    def get_read_timeout(self, func_name, event_type, cold=False):
+        """Get the read timeout of a function, None for the endpoint one.
+        When emulating the limits, it is the function timeout of the event
+        type, plus the container start of cold invocations.
+        """
+        if ctx.options.lambda_at_edge_emulate_limits:
+            timeout = self.get_function_timeout(func_name, event_type)
+            return timeout + FUNCTION_TIMEOUT_MARGIN if cold else timeout
+        timeout = self.functions.get(func_name, {}).get("Timeout")
+        if not ctx.options.lambda_at_edge_function_timeouts:
+            return None
+        if not isinstance(timeout, (int, float)):
+            return None
+        return timeout + FUNCTION_TIMEOUT_MARGIN
+
+    def get_function_timeout(self, func_name, event_type):
+        """Get the Timeout of a function, capped by the quota of the event type"""
+        timeout = self.functions.get(func_name, {}).get("Timeout")
+        if not isinstance(timeout, (int, float)):
+            timeout = DEFAULT_FUNCTION_TIMEOUT
+        return min(timeout, EVENT_TIMEOUT_LIMITS[event_type])
+
+    def get_cache_policy(self, res, behavior):
+        """Get the cache policy of a CloudFront cache behavior"""
+        if "CachePolicyId" not in behavior:
+            if "ForwardedValues" in behavior:
+                return CachePolicy.from_forwarded_values(behavior)
+            return CachePolicy()
+        policy_id = behavior["CachePolicyId"]
+        if isinstance(policy_id, str):
+            if policy_id in MANAGED_CACHE_POLICIES:
+                return CachePolicy(*MANAGED_CACHE_POLICIES[policy_id])
+            ctx.log.warn(f"Lambda@Edge: unknown cache policy '{policy_id}'")
+            return CachePolicy()
+        name = self.resolve_ref(res, policy_id)
+        if name is None or res[name]["Type"] != "AWS::CloudFront::CachePolicy":
+            ctx.log.warn("Lambda@Edge: not a CloudFront CachePolicy reference")
+            return CachePolicy()
+        return CachePolicy.from_config(res[name]["Properties"]["CachePolicyConfig"])
 
     def resolve_ref(self, res, ref):
         if "Ref" in ref:
@@ -193,8 +2461,9 @@ class LambdaEdgeLocalProxy:
                 ctx.log.error(f"Cannot resolve reference {ref} {ref_name}")
         return None
 
-    def add_funcs(self, res, path, funcs):
-        """Add template.yaml functions to self.funcs"""
+    def add_funcs(self, res, route, funcs):
+        """Add template.yaml functions to a route"""
+        path = route.pattern
         for func in funcs:
             event_type = func["EventType"] if "EventType" in func else ""
             include_body = func["IncludeBody"] if "IncludeBody" in func else False
@@ -222,84 +2491,144 @@ class LambdaEdgeLocalProxy:
             else:
                 ctx.log.warn("Lambda@Edge: LambdaFunctionARN unsupported syntax")
                 continue
-            if event_type == "viewer-request":
-                ctx.log.info(
-                    f"Lambda@Edge: viewer-request '{path}' route to '{func_name}'"
-                )
-            elif event_type == "origin-request":
+            if event_type in SUPPORTED_EVENT_TYPES:
                 ctx.log.info(
-                    f"Lambda@Edge: origin-request '{path}' route to '{func_name}'"
+                    f"Lambda@Edge: {event_type} '{path}' route to '{func_name}'"
                 )
             else:
                 ctx.log.warn(f"Lambda@Edge: EventType '{event_type}' not supported")
-            self.funcs[event_type].append((path, func_name, include_body))
+            route.funcs[event_type] = (func_name, include_body)
 
     def get_client_ip(self, flow):
         """Retrieve client ip from mitmproxy flow"""
         return flow.client_conn.ip_address
 
-    def get_headers(self, flow):
+    def get_message(self, flow, event_type):
+        """Get the mitmproxy request or response an event type works on"""
+        if event_type.endswith("-response"):
+            return flow.response
+        return flow.request
+
+    def get_headers(self, flow, event_type="viewer-request"):
         """Tranlate mitmproxy headers to lambda@edge headers"""
-        items = flow.request.headers.items()
-        headers = dict(
-            (x[0].lower(), [{"key": x[0], "value": x[1]}])
-            for x in items
-            if x[0].lower() not in FORBIDDEN_HEADERS
-        )
+        headers = {}
+        # Raw fields avoid mitmproxy's per-name scan of all headers
+        for (k, v) in self.get_message(flow, event_type).headers.fields:
+            name = decode_header(k)
+            key = name.lower()
+            if is_forbidden_header(key):
+                continue
+            if key in headers:
+                # Fold repeated headers, as mitmproxy does
+                headers[key][0]["value"] += ", " + decode_header(v)
+            else:
+                headers[key] = [{"key": name, "value": decode_header(v)}]
         return headers
 
-    def set_headers(self, flow, payload):
-        """Translate lambda@edge headers to mitmproxy headers"""
+    def set_headers(self, flow, payload, event_type="viewer-request"):
+        """Translate lambda@edge headers to mitmproxy headers.
+        The payload is diffed against the current headers in a single pass,
+        and the headers are only changed if every change is allowed.
+        """
         if not "headers" in payload:
             return
         headers = get_headers_capitalized(payload["headers"])
-        if not headers:
+        if headers is None:
             msg = f"Lambda@Edge: malformed headers"
             ctx.log.warn(msg)
             flow.response = http.HTTPResponse.make(502, msg)
             return
-        for x in headers.keys():
-            if x.lower() in FORBIDDEN_HEADERS:
-                msg = f"Lambda@Edge: included forbidden header '{x}' in response"
+        message = self.get_message(flow, event_type)
+        readonly_headers = READONLY_HEADERS[event_type]
+        # lowercase name -> (name, value) of the headers still to be matched
+        new_headers = {}
+        for (k, v) in headers.items():
+            key = k.lower()
+            if is_forbidden_header(key):
+                msg = f"Lambda@Edge: included forbidden header '{k}' in response"
                 ctx.log.warn(msg)
                 flow.response = http.HTTPResponse.make(502, msg)
                 return
-        for (k, v) in headers.items():
-            if k not in flow.request.headers:
-                if k.lower() in READONLY_HEADERS_VIEWER_REQUESTS:
-                    msg = f"Lambda@Edge: added read-only header '{k}'"
-                    ctx.log.warn(msg)
-                    flow.response = http.HTTPResponse.make(502, msg)
-                    return
-                ctx.log.info(f"Lambda@Edge: *-request added header: '{k}': '{v}'")
-                flow.request.headers[k] = v
-            elif flow.request.headers[k] != v:
-                if k.lower() in READONLY_HEADERS_VIEWER_REQUESTS:
-                    msg = (
-                        f"Lambda@Edge: modified read-only header '{k}' "
-                        + f"from '{flow.request.headers[k]}' to '{v}'"
-                    )
-                    ctx.log.warn(msg)
-                    flow.response = http.HTTPResponse.make(502, msg)
-                    return
-                ctx.log.info(f"Lambda@Edge: *-request modified header to: '{k}': '{v}'")
-                flow.request.headers[k] = v
-        for (k, v) in flow.request.headers.items():
-            if k not in headers:
-                if k.lower() in READONLY_HEADERS_VIEWER_REQUESTS:
-                    msg = f"Lambda@Edge: removed read-only header '{k}'"
+            new_headers[key] = (k, v)
+        # lowercase name -> folded value of the current headers
+        old_headers = {}
+        keys = []
+        for (k, v) in message.headers.fields:
+            key = decode_header(k).lower()
+            keys.append(key)
+            if key in old_headers:
+                old_headers[key] += ", " + decode_header(v)
+            else:
+                old_headers[key] = decode_header(v)
+        # lowercase name -> replacement field, or None to remove the header
+        replaced = {}
+        for (key, old_value) in old_headers.items():
+            if is_forbidden_header(key):
+                # Forbidden headers are not sent to lambda@edge, so keep them
+                continue
+            if key not in new_headers:
+                if key in readonly_headers:
+                    msg = f"Lambda@Edge: removed read-only header '{key}'"
                     ctx.log.warn(msg)
                     flow.response = http.HTTPResponse.make(502, msg)
                     return
-                ctx.log.info(f"Lambda@Edge: *-request removed header: '{k}'")
-                del flow.request.headers[k]
+                replaced[key] = None
+                continue
+            (name, value) = new_headers.pop(key)
+            if value == old_value:
+                continue
+            if key in readonly_headers:
+                msg = (
+                    f"Lambda@Edge: modified read-only header '{name}' "
+                    + f"from '{old_value}' to '{value}'"
+                )
+                ctx.log.warn(msg)
+                flow.response = http.HTTPResponse.make(502, msg)
+                return
+            replaced[key] = (encode_header(name), encode_header(value))
+        for (key, (name, value)) in new_headers.items():
+            if key in readonly_headers:
+                msg = f"Lambda@Edge: added read-only header '{name}'"
+                ctx.log.warn(msg)
+                flow.response = http.HTTPResponse.make(502, msg)
+                return
+        if not replaced and not new_headers:
+            return
+        record = self.get_access_record(flow)
+        if record:
+            changed = dict(replaced)
+        fields = []
+        for (key, field) in zip(keys, message.headers.fields):
+            if key not in replaced:
+                fields.append(field)
+            elif replaced[key]:
+                # Replace the first field, drop repeated ones
+                fields.append(replaced[key])
+                replaced[key] = None
+        for (name, value) in new_headers.values():
+            fields.append((encode_header(name), encode_header(value)))
+        if record:
+            record.changes.append(
+                {
+                    "event_type": event_type,
+                    "headers": {
+                        "modified": [k for (k, v) in changed.items() if v],
+                        "removed": [k for (k, v) in changed.items() if not v],
+                        "added": list(new_headers),
+                    },
+                }
+            )
+        message.headers.fields = tuple(fields)
 
     def get_method(self, flow):
         """Get HTTP method from mitmproxy"""
         return flow.request.method
 
-    def get_body(self, flow, include_body):
-        """Translate mitmproxy body to lambda@edge body"""
+    def get_body(self, flow, include_body, event_type="viewer-request"):
+        """Translate mitmproxy body to lambda@edge body.
+        The body is truncated to the CloudFront limit of the event type and
+        kept as base64 bytes, see dumps_event().
+        """
         if not include_body:
             # TODO - not sure what to include if there is no body
             return {
@@ -309,14 +2638,16 @@ class LambdaEdgeLocalProxy:
                 "data": "",
             }
         else:
+            content = self.get_message(flow, event_type).content
+            (data, truncated) = encode_body(content, BODY_SIZE_LIMITS[event_type])
             return {
-                "inputTruncated": False,
+                "inputTruncated": truncated,
                 "action": "read-only",
                 "encoding": "base64",
-                "data": str(base64.b64encode(flow.request.content), "utf-8"),
+                "data": data,
             }
 
-    def set_body(self, flow, payload):
+    def set_body(self, flow, payload, event_type="viewer-request"):
         """Translate lambda@edge body to mitmproxy body"""
         if "body" not in payload:
             return
@@ -325,18 +2656,32 @@ class LambdaEdgeLocalProxy:
             return
         action = body["action"]
         if action == "replace":
-            if body["encoding"] == "base64":
-                ctx.log.info("Lambda@Edge: *-request replaced body using base64")
-                new_body = base64.b64decode(body["data"])
-            elif body["encoding"] == "text":
-                ctx.log.info("Lambda@Edge: *-request replaced body using text")
-                new_body = bytes(body["data"], "utf-8")
-            else:
-                msg = f"Lambda@Edge: unknown body encoding '{body['encoding']}'"
-                ctx.log.warn(msg)
-                flow.response = http.HTTPResponse.make(502, msg)
+            new_body = self.get_new_body(flow, body["data"], body["encoding"])
+            if new_body is None:
                 return
-            flow.request.content = new_body
+            record = self.get_access_record(flow)
+            if record:
+                record.changes.append(
+                    {"event_type": event_type, "body": body["encoding"]}
+                )
+            self.get_message(flow, event_type).content = new_body
+
+    def get_new_body(self, flow, data, encoding):
+        """Decode a body from lambda@edge.
+        Returns: body bytes, or None after setting an error response
+        """
+        try:
+            new_body = decode_body(data, encoding)
+        except (ValueError, TypeError, AttributeError):
+            msg = f"Lambda@Edge: malformed {encoding} body"
+            ctx.log.warn(msg)
+            flow.response = http.HTTPResponse.make(502, msg)
+            return None
+        if new_body is None:
+            msg = f"Lambda@Edge: unknown body encoding '{encoding}'"
+            ctx.log.warn(msg)
+            flow.response = http.HTTPResponse.make(502, msg)
+        return new_body
 
     def get_uri(self, flow):
         """Get URI from mitmproxy"""
@@ -361,153 +2706,771 @@ class LambdaEdgeLocalProxy:
         if querystring != "":
             uri += "?" + querystring
         if flow.request.path != uri:
-            ctx.log.info(f"Lambda@Edge: *-request replaced URI to '{uri}'")
+            record = self.get_access_record(flow)
+            if record:
+                record.changes.append({"uri": uri})
             flow.request.path = uri
 
     def set_response(self, flow, payload):
-        """Set mitmproxy response from lambda@edge, if needed"""
+        """Set mitmproxy response from lambda@edge, if needed.
+        Returns: True if the response was generated from the payload
+        """
         if "status" not in payload:
-            return
+            return False
         content = payload["body"] if "body" in payload else ""
         encoding = payload["bodyEncoding"] if "bodyEncoding" in payload else "text"
-        if encoding == "base64":
-            content = str(base64.b64decode(content), "utf-8")
+        content = self.get_new_body(flow, content, encoding)
+        if content is None:
+            return
         headers = payload["headers"] if "headers" in payload else {}
         # TODO not sure which headers are read-only in this situation
         headers = get_headers_capitalized(headers)
-        if not headers:
+        if headers is None:
             msg = f"Lambda@Edge: malformed headers"
             ctx.log.warn(msg)
             flow.response = http.HTTPResponse.make(502, msg)
             return
         for x in headers.keys():
-            if x.lower() in FORBIDDEN_HEADERS:
+            if is_forbidden_header(x.lower()):
                 msg = f"Lambda@Edge: adding forbidden header '{x}'"
                 ctx.log.warn(msg)
                 flow.response = http.HTTPResponse.make(502, msg)
                 return
-        status_code = payload["status"]
-        ctx.log.info(f"Lambda@Edge: *-request directly responded: '{status_code}'")
+        status_code = self.get_status(flow, payload)
+        if status_code is None:
+            return
+        record = self.get_access_record(flow)
+        if record:
+            record.changes.append({"response": status_code})
         flow.response = http.HTTPResponse.make(status_code, content, headers)
         if "statusDescription" in payload:
             flow.response.reason = payload["statusDescription"]
+        return True
+
+    def get_status(self, flow, payload):
+        """Get the HTTP status code from a lambda@edge payload.
+        Lambda@Edge sends it as a string, but numbers are accepted too.
+        """
+        try:
+            return int(payload["status"])
+        except (TypeError, ValueError):
+            msg = f"Lambda@Edge: malformed status '{payload['status']}'"
+            ctx.log.warn(msg)
+            flow.response = http.HTTPResponse.make(502, msg)
+            return None
+
+    def get_response(self, flow, include_body, event_type):
+        """Translate mitmproxy response to lambda@edge response"""
+        response = {
+            "status": str(flow.response.status_code),
+            "statusDescription": flow.response.reason,
+            "headers": self.get_headers(flow, event_type),
+        }
+        if include_body:
+            response["body"] = self.get_body(flow, include_body, event_type)
+        return response
+
+    def update_response(self, flow, payload, event_type):
+        """Apply a lambda@edge *-response payload to the mitmproxy response"""
+        if "status" in payload:
+            status_code = self.get_status(flow, payload)
+            if status_code is None:
+                return
+            if status_code != flow.response.status_code:
+                record = self.get_access_record(flow)
+                if record:
+                    record.changes.append(
+                        {"event_type": event_type, "status": status_code}
+                    )
+                flow.response.status_code = status_code
+        if "statusDescription" in payload:
+            flow.response.reason = payload["statusDescription"]
+        response = flow.response
+        self.set_headers(flow, payload, event_type)
+        if flow.response is not response:
+            return
+        if "body" in payload and isinstance(payload["body"], str):
+            encoding = payload.get("bodyEncoding", "text")
+            content = self.get_new_body(flow, payload["body"], encoding)
+            if content is not None:
+                flow.response.content = content
+        else:
+            self.set_body(flow, payload, event_type)
 
-    def find_func_from_path(self, uri, event_type) -> (str, bool):
-        """Find lambda@edge function from URI.
-        Returns: (function name, include body)
+    def find_route(self, uri) -> typing.Optional[Route]:
+        """Find the CloudFront cache behavior for a URI.
+        Returns: route with the functions of every event type, or None
         """
-        funcs = self.funcs[event_type]
-        for (pattern, func_name, include_body) in funcs:
-            if fnmatch.fnmatchcase(uri, pattern):
-                return (func_name, include_body)
-        return (None, None)
+        return self.routes.lookup(uri)
 
     def request(self, flow: http.HTTPFlow):
         """Process a request from mitmproxy.
         This function is a mitmproxy hook.
         """
-        uri = self.get_uri(flow)
-        self.request_to_lambda(flow, uri, "viewer-request")
+        defer_hook(flow, self.process_request(flow))
+
+    async def process_request(self, flow: http.HTTPFlow):
+        """Run viewer-request and origin-request functions for a flow"""
+        started = time.perf_counter()
+        route = self.find_route(self.get_uri(flow))
+        self.metrics.observe(
+            "lambda_at_edge_route_seconds", (), time.perf_counter() - started
+        )
+        if route is None:
+            return
+        if self.profile_dir:
+            header = ctx.options.lambda_at_edge_profile_header
+            if header and header in flow.request.headers:
+                del flow.request.headers[header]
+                self.profiled_flows.add(flow)
+            elif random.random() < ctx.options.lambda_at_edge_profile_sample:
+                self.profiled_flows.add(flow)
+        if self.access_log:
+            # Unsampled flows are recorded too, in case they fail
+            sampled = random.random() < ctx.options.lambda_at_edge_access_log_sample
+            self.access_records[flow] = AccessRecord(flow, route, sampled)
+            try:
+                await self.run_request_events(flow, route)
+            finally:
+                if flow not in self.flow_states:
+                    self.log_access(flow)
+        else:
+            await self.run_request_events(flow, route)
+
+    async def run_request_events(self, flow: http.HTTPFlow, route: Route):
+        await self.request_to_lambda(flow, route, "viewer-request")
         if flow.response:
             return
-        self.request_to_lambda(flow, uri, "origin-request")
+        state = FlowState(route)
+        self.flow_states[flow] = state
+        if self.cache:
+            # The cache key is built after viewer-request changed the request
+            key = route.cache_policy.cache_key(flow, self.get_querystring(flow))
+            if key is not None and self.cache_lookup(flow, key):
+                state.events = ("viewer-response",)
+                return
+            state.cache_miss = True
+            state.cache_key = key
+        if await self.request_to_lambda(flow, route, "origin-request"):
+            # CloudFront skips origin-response for generated responses
+            state.events = ("viewer-response",)
+        elif flow.response:
+            del self.flow_states[flow]
+        else:
+            state.events = ("origin-response", "viewer-response")
+
+    def cache_lookup(self, flow: http.HTTPFlow, key):
+        """Respond from the edge cache, if possible.
+        Returns: True on a cache hit
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            return False
+        (response, age) = entry
+        flow.response = response.copy()
+        flow.response.headers["Age"] = str(age)
+        flow.response.headers["X-Cache"] = "Hit from cloudfront"
+        return True
+
+    def cache_response(self, flow: http.HTTPFlow, state: FlowState):
+        """Store a response from the origin in the edge cache"""
+        if not state.cache_miss or self.cache is None:
+            return
+        if (
+            state.cache_key is not None
+            and flow.response.status_code in CACHEABLE_STATUS_CODES
+        ):
+            ttl = state.route.cache_policy.ttl(flow.response)
+            self.cache.put(state.cache_key, flow.response, ttl)
+        flow.response.headers["X-Cache"] = "Miss from cloudfront"
 
     def response(self, flow: http.HTTPFlow):
         """Process a response from mitmproxy.
         This function is a mitmproxy hook.
-        Not yet implemented - we need to keep the original uri
-        in the flow structure to find the appropriate functions.
         """
-        pass
+        state = self.flow_states.pop(flow, None)
+        if state is None:
+            return
+        if not any(event_type in state.route.funcs for event_type in state.events):
+            self.cache_response(flow, state)
+            if self.access_log:
+                self.log_access(flow)
+            return
+        defer_hook(flow, self.process_response(flow, state))
+
+    def error(self, flow: http.HTTPFlow):
+        """Process a flow failing without response, e.g. when the origin is
+        unreachable: response functions do not run, but the flow is logged.
+        This function is a mitmproxy hook.
+        """
+        state = self.flow_states.pop(flow, None)
+        if state is not None and self.access_log:
+            self.log_access(flow)
+
+    async def process_response(self, flow: http.HTTPFlow, state: FlowState):
+        """Run origin-response and viewer-response functions for a flow"""
+        try:
+            origin_status = None
+            if "origin-response" in state.events:
+                origin_status = flow.response.status_code
+                await self.response_to_lambda(flow, state.route, "origin-response")
+            self.cache_response(flow, state)
+            # CloudFront does not run viewer-response for origin errors,
+            # only for error responses generated by functions
+            origin_error = (
+                origin_status is not None
+                and origin_status >= 400
+                and flow.response.status_code == origin_status
+            )
+            if "viewer-response" in state.events and not origin_error:
+                await self.response_to_lambda(flow, state.route, "viewer-response")
+        finally:
+            if self.access_log:
+                self.log_access(flow)
 
-    def request_to_lambda(self, flow: http.HTTPFlow, uri, event_type):
-        (func_name, include_body) = self.find_func_from_path(uri, event_type)
-        if func_name == None:
+    def get_access_record(self, flow):
+        """Get the AccessRecord of a flow, or None"""
+        if not self.access_log:
+            return None
+        return self.access_records.get(flow)
+
+    def log_access(self, flow: http.HTTPFlow):
+        """Write the AccessRecord of a flow whose functions all ran.
+        Errors are written even for flows left out by sampling.
+        """
+        record = self.access_records.pop(flow, None)
+        if record is None:
             return
-        req = json.dumps(
-            {
-                "Records": [
-                    {
-                        "cf": {
-                            "config": {
-                                "distributionDomainName": "dummy.cloudfront.net",
-                                "distributionId": "DUMMYIDEXAMPLE",
-                                "eventType": event_type,
-                                "requestId": "IsThisReallyNeeded",
-                            },
-                            "request": {
-                                "clientIp": self.get_client_ip(flow),
-                                "headers": self.get_headers(flow),
-                                "method": self.get_method(flow),
-                                "querystring": self.get_querystring(flow),
-                                "uri": self.get_uri(flow),
-                                "body": self.get_body(flow, include_body),
-                            },
-                        }
-                    }
-                ]
-            }
+        level = record.finish(flow)
+        if level is None:
+            return
+        if ACCESS_LOG_LEVELS.index(level) >= ACCESS_LOG_LEVELS.index(
+            ctx.options.lambda_at_edge_access_log_level
+        ):
+            self.access_log.write(record)
+
+    def running(self):
+        """Start the periodic metrics summary and template reloading.
+        This function is a mitmproxy hook.
+        """
+        if self.metrics_task is None:
+            self.metrics_task = asyncio.ensure_future(self.log_metrics())
+        if self.template_task is None:
+            self.template_task = asyncio.ensure_future(self.watch_template())
+
+    async def watch_template(self):
+        """Reload the template when its file changes.
+        The file is parsed in a thread, and a template that cannot be loaded
+        keeps the last good one.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            interval = ctx.options.lambda_at_edge_watch_interval
+            await asyncio.sleep(interval if interval > 0 else 1)
+            path = ctx.options.lambda_at_edge_cf_template
+            if interval <= 0:
+                continue
+            try:
+                if template_stat(path) == self.template_stat:
+                    continue
+                (stat, data) = await loop.run_in_executor(None, read_template, path)
+                if path != ctx.options.lambda_at_edge_cf_template:
+                    # configure() loaded another template meanwhile
+                    continue
+                self.template_stat = stat
+                self.load_template(path, data)
+                ctx.log.info(f"Lambda@Edge: reloaded '{path}'")
+            except Exception as e:
+                if self.template_stat is not None:
+                    ctx.log.error(
+                        "Lambda@Edge: keeping the last good template, "
+                        + f"could not reload '{path}': {e}"
+                    )
+                # Do not retry before the file changes again
+                try:
+                    self.template_stat = template_stat(path)
+                except OSError:
+                    self.template_stat = None
+
+    async def log_metrics(self):
+        """Log a metrics summary every lambda_at_edge_metrics_interval seconds"""
+        while True:
+            interval = ctx.options.lambda_at_edge_metrics_interval
+            await asyncio.sleep(interval if interval > 0 else 1)
+            if interval > 0:
+                for line in self.metrics.summary():
+                    ctx.log.info(line)
+
+    def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+
+    def done(self):
+        """Shut down the invocation thread pool and the metrics.
+        This function is a mitmproxy hook.
+        """
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.metrics_task:
+            self.metrics_task.cancel()
+            self.metrics_task = None
+        if self.template_task:
+            self.template_task.cancel()
+            self.template_task = None
+        if self.prewarm_task:
+            self.prewarm_task.cancel()
+            self.prewarm_task = None
+        self.stop_metrics_server()
+        if self.python_workers:
+            self.python_workers.close()
+            self.python_workers = None
+        if self.access_log:
+            self.access_log.close()
+            self.access_log = None
+
+    def invoke(self, func_name, req, event_type, cold=False):
+        """Invoke a lambda@edge function and read its payload.
+        Runs in the thread pool, so it must not touch the flow.
+        Returns: (invoke response, raw payload, (start, invoked, read) times)
+        """
+        started = time.perf_counter()
+        pool = self.function_endpoints.get(func_name, self.endpoints)
+        read_timeout = self.get_read_timeout(func_name, event_type, cold)
+        tried = []
+        while True:
+            endpoint = pool.acquire(tried)
+            if endpoint is None:
+                raise botocore.exceptions.EndpointConnectionError(
+                    endpoint_url=self.endpoint
+                )
+            try:
+                client = endpoint.clients.get(read_timeout)
+                res = client.invoke(FunctionName=func_name, Payload=req)
+                invoked = time.perf_counter()
+                if res["StatusCode"] != 200:
+                    return (res, None, (started, invoked, invoked))
+                payload_raw = res["Payload"].read()
+                return (res, payload_raw, (started, invoked, time.perf_counter()))
+            except (
+                ConnectionRefusedError,
+                botocore.exceptions.EndpointConnectionError,
+            ):
+                # The invocation never reached the endpoint: eject it and
+                # retry on the others
+                pool.eject(endpoint)
+                self.metrics.inc(
+                    "lambda_at_edge_endpoint_ejections_total",
+                    (("endpoint", endpoint.url),),
+                )
+                tried.append(endpoint)
+                if len(tried) == len(pool.endpoints):
+                    raise
+            finally:
+                pool.release(endpoint)
+
+    def get_invoke(self, func_name, event_type, request, response=None):
+        """Get the invoke function of a function and its event.
+        Returns: (invoke or invoke_python, event)
+        """
+        if self.python_workers and func_name in self.python_handlers:
+            return (self.invoke_python, make_event(event_type, request, response))
+        return (self.invoke, dumps_event(event_type, request, response))
+
+    def invoke_python(self, func_name, event, event_type, cold=False):
+        """Run a Python handler on a worker process.
+        Runs in the thread pool, like invoke(), and returns the same values,
+        with the payload already parsed unless the handler timed out.
+        """
+        started = time.perf_counter()
+        (code_dir, handler) = self.python_handlers[func_name]
+        props = self.functions.get(func_name, {})
+        if ctx.options.lambda_at_edge_emulate_limits:
+            timeout = self.get_function_timeout(func_name, event_type)
+        else:
+            timeout = props.get("Timeout", DEFAULT_FUNCTION_TIMEOUT)
+        memory = props.get("MemorySize", DEFAULT_FUNCTION_MEMORY)
+        try:
+            (function_error, payload) = self.python_workers.call(
+                code_dir, handler, event, (func_name, memory, timeout), timeout
+            )
+        except TimeoutError:
+            # What sam local returns
+            function_error = None
+            payload = f"Task timed out after {timeout:.2f} seconds".encode()
+        res = {"StatusCode": 200}
+        if function_error:
+            res["FunctionError"] = function_error
+        invoked = time.perf_counter()
+        return (res, payload, (started, invoked, invoked))
+
+    def start_invocation(self, flow: http.HTTPFlow, func_name, event_type):
+        invocation = Invocation(self.metrics, func_name, event_type)
+        record = self.get_access_record(flow)
+        if record:
+            record.invocations.append(invocation)
+        return invocation
+
+    async def request_to_lambda(self, flow: http.HTTPFlow, route: Route, event_type):
+        """Run a *-request function.
+        Returns: True if the function generated a response
+        """
+        if event_type not in route.funcs:
+            return False
+        if self.profile_capture is None and flow in self.profiled_flows:
+            return await self.profile_request(flow, route, event_type)
+        (func_name, include_body) = route.funcs[event_type]
+        invocation = self.start_invocation(flow, func_name, event_type)
+        request = {
+            "clientIp": self.get_client_ip(flow),
+            "headers": self.get_headers(flow),
+            "method": self.get_method(flow),
+            "querystring": self.get_querystring(flow),
+            "uri": self.get_uri(flow),
+            "body": self.get_body(flow, include_body, event_type),
+        }
+        key = None
+        change = None
+        if self.results and func_name in self.memoized:
+            key = (func_name, result_key(event_type, request, self.memoized[func_name]))
+            change = self.results.get(key)
+            invocation.memo("miss" if change is None else "hit")
+        if change is not None:
+            invocation.mark("memo")
+            payload = apply_request_change(request, change)
+        else:
+            if func_name in self.coalesced:
+                in_flight_key = (
+                    func_name,
+                    result_key(event_type, request, self.coalesced[func_name]),
+                )
+                payload = await self.call_coalesced(
+                    flow, invocation, request, in_flight_key
+                )
+            else:
+                payload = await self.call_lambda(flow, invocation, request)
+            if payload is None:
+                return False
+            if key is not None:
+                self.results.put(key, request_change(request, payload))
+        if flow_killed(flow):
+            return False
+        try:
+            if "status" in payload:
+                # Do not connect to proxy, respond directly
+                generated = self.set_response(flow, payload)
+                if generated:
+                    invocation.outcome = "generated"
+                invocation.mark("apply")
+                return generated
+            # Overwrite headers, URI and body
+            # NOTE - set_body() may change Content-Length
+            # So, set_headers() must be called before set_body().
+            self.set_headers(flow, payload, event_type)
+            self.set_body(flow, payload, event_type)
+            self.set_uri(flow, payload)
+        except Exception as e:
+            self.invocation_exception(flow, invocation, e)
+            return False
+        invocation.mark("apply")
+        return False
+
+    async def profile_request(self, flow: http.HTTPFlow, route: Route, event_type):
+        """Run a *-request function in a profile capture, written in the
+        background to lambda_at_edge_profile_dir.
+        Returns: True if the function generated a response
+        """
+        directory = self.profile_dir
+        mode = ctx.options.lambda_at_edge_profile_mode
+        capture = self.profile_capture = ProfileCapture(
+            flow, mode in ("cpu", "both"), mode in ("memory", "both")
         )
         try:
-            res = self.lambda_client.invoke(FunctionName=func_name, Payload=req)
-            if res["StatusCode"] != 200:
-                msg = "Lambda@Edge StatusCode: " + str(res["StatusCode"])
-                ctx.log.error(msg)
-                flow.response = http.HTTPResponse.make(502, msg)
-                return
-            payload_raw = res["Payload"].read()
-            if not payload_raw:
-                msg = f"Lambda@Edge: no payload"
+            return await self.request_to_lambda(flow, route, event_type)
+        finally:
+            capture.finish()
+            self.profile_capture = None
+            tags = (route.pattern, route.funcs[event_type][0], event_type)
+            name = "-".join(
+                [time.strftime("%Y%m%dT%H%M%S"), uuid.uuid4().hex[:8]]
+                + [re.sub(r"[^\w.-]+", "_", tag).strip("_") or "_" for tag in tags]
+            )
+            future = asyncio.get_event_loop().run_in_executor(
+                None, capture.write, os.path.join(directory, name)
+            )
+            future.add_done_callback(self.profile_written)
+
+    def profile_written(self, future):
+        try:
+            paths = future.result()
+        except Exception as e:
+            ctx.log.error(f"Lambda@Edge: could not write the profile: {e}")
+            return
+        ctx.log.info(f"Lambda@Edge: profile written to {', '.join(paths)}")
+
+    async def call_coalesced(
+        self, flow: http.HTTPFlow, invocation: Invocation, request, key
+    ):
+        """Invoke a function once for concurrent requests with the same key.
+        The first request invokes the function, the others wait for and apply
+        the change it made to its event (see request_change()), or share its
+        error response.
+        Returns: payload, or None after setting an error response, or without
+        one when the function is bypassed
+        """
+        future = self.in_flight.get(key)
+        if future is not None:
+            invocation.coalesced()
+            # shield: a cancelled waiter must not cancel the others
+            result = await asyncio.shield(future)
+            invocation.mark("coalesce_wait")
+            if result is None:
+                msg = "Lambda@Edge: the coalesced invocation failed"
                 ctx.log.warn(msg)
+                invocation.error("coalesced_failure", 502)
                 flow.response = http.HTTPResponse.make(502, msg)
-                return
-            try:
-                payload = json.loads(payload_raw)
-            except json.decoder.JSONDecodeError as e:
-                # If payload_raw starts with b'Task timed out after
-                # then it's a timeout error - error 503
-                msg = f"Lambda@Edge non-JSON payload: '{payload_raw}'"
-                ctx.log.warn(msg)
-                flow.response = http.HTTPResponse.make(503, msg)
-                return
-            if "FunctionError" in res:
+                return None
+            (change, response) = result
+            if change is None:
+                if response:
+                    flow.response = response.copy()
+                return None
+            return apply_request_change(request, change)
+        future = self.in_flight[key] = asyncio.get_event_loop().create_future()
+        # Stays None if the invocation raises or is cancelled
+        result = None
+        try:
+            payload = await self.call_lambda(flow, invocation, request)
+            change = None if payload is None else request_change(request, payload)
+            result = (change, flow.response)
+            return payload
+        finally:
+            del self.in_flight[key]
+            future.set_result(result)
+
+    async def response_to_lambda(self, flow: http.HTTPFlow, route: Route, event_type):
+        """Run a *-response function"""
+        if event_type not in route.funcs:
+            return
+        (func_name, include_body) = route.funcs[event_type]
+        invocation = self.start_invocation(flow, func_name, event_type)
+        request = {
+            "clientIp": self.get_client_ip(flow),
+            "headers": self.get_headers(flow),
+            "method": self.get_method(flow),
+            "querystring": self.get_querystring(flow),
+            "uri": self.get_uri(flow),
+        }
+        response = self.get_response(flow, include_body, event_type)
+        payload = await self.call_lambda(flow, invocation, request, response)
+        if payload is None or flow_killed(flow):
+            return
+        try:
+            self.update_response(flow, payload, event_type)
+        except Exception as e:
+            self.invocation_exception(flow, invocation, e)
+            return
+        invocation.mark("apply")
+
+    def invocation_exception(self, flow, invocation: Invocation, e):
+        """Set the 502 error response of an unexpected exception while
+        invoking a function or applying its result
+        """
+        msg = f"Lambda@Edge: Exception: {repr(e)}"
+        ctx.log.error(msg)
+        traceback.print_exc()
+        invocation.error("exception", 502)
+        flow.response = http.HTTPResponse.make(502, msg)
+
+    def check_quotas(self, flow, invocation: Invocation, payload_raw, payload, elapsed):
+        """Apply the Lambda@Edge quotas to an invocation.
+        The timeout is enforced by the read timeout, this catches warm
+        invocations answering just in time; cold ones get
+        FUNCTION_TIMEOUT_MARGIN more for their container start.
+        Returns: True if within the quotas, else False after setting an error
+        response
+        """
+        event_type = invocation.event_type
+        timeout = self.get_function_timeout(invocation.func_name, event_type)
+        if invocation.start == "warm" and elapsed > timeout:
+            msg = (
+                f"Lambda@Edge: function ran for {elapsed:.2f}s, "
+                + f"over its {timeout}s timeout"
+            )
+            ctx.log.warn(msg)
+            invocation.error("limit_timeout", 503)
+            flow.response = http.HTTPResponse.make(503, msg)
+            return False
+        if isinstance(payload, dict) and (
+            "status" in payload or event_type.endswith("-response")
+        ):
+            if not isinstance(payload_raw, bytes):
+                payload_raw = json_dumps(payload)
+            limit = RESPONSE_SIZE_LIMITS[event_type]
+            if len(payload_raw) > limit:
                 msg = (
-                    f"Lambda@Edge FunctionError: '{res['FunctionError']}'\n'{payload}'"
+                    f"Lambda@Edge: generated response of {len(payload_raw)} "
+                    + f"bytes, over the {event_type} limit of {limit}"
                 )
                 ctx.log.warn(msg)
-                flow.response = http.HTTPResponse.make(503, msg)
-                return
-            if not isinstance(payload, dict):
-                msg = f"Lambda@Edge: malformed payload '{payload}'"
-                ctx.log.warn(msg)
+                invocation.error("response_too_large", 502)
                 flow.response = http.HTTPResponse.make(502, msg)
-                return
-            if "status" in payload:
-                # Do not connect to proxy, respond directly
-                self.set_response(flow, payload)
-            else:
-                # Overwrite headers, URI and body
-                # NOTE - set_body() may change Content-Length
-                # So, set_headers() must be called before set_body().
-                self.set_headers(flow, payload)
-                self.set_body(flow, payload)
-                self.set_uri(flow, payload)
-        except (
-            botocore.exceptions.ReadTimeoutError,
-            botocore.exceptions.ClientError,
-            ConnectionRefusedError,
-            botocore.exceptions.EndpointConnectionError,
-        ) as e:
-            msg = f"Lambda@Edge: Exception: {repr(e)}"
-            ctx.log.warn(msg)
-            if isinstance(e, json.decoder.JSONDecodeError):
-                ctx.log.warn(payload)
-            flow.response = http.HTTPResponse.make(502, msg)
-        except Exception as e:
-            msg = f"Lambda@Edge: Exception: {repr(e)}"
-            ctx.log.error(msg)
-            traceback.print_exc(e)
-            flow.response = http.HTTPResponse.make(502, msg)
+                return False
+        return True
+
+    async def call_lambda(
+        self, flow: http.HTTPFlow, invocation: Invocation, request, response=None
+    ):
+        """Invoke a lambda@edge function with a request (and response) event.
+        Returns: payload, or None after setting an error response, or without
+        one when the function is bypassed
+        """
+        breaker = self.get_breaker(invocation.func_name)
+        token = None
+        if breaker:
+            token = breaker.allow()
+            if token is None:
+                if ctx.options.lambda_at_edge_breaker_action == "bypass":
+                    invocation.outcome = "bypassed"
+                    self.metrics.inc("lambda_at_edge_bypassed_total", invocation.labels)
+                    return None
+                status_code = ctx.options.lambda_at_edge_breaker_status
+                msg = f"Lambda@Edge: circuit breaker of {invocation.func_name} open"
+                invocation.error("circuit_open", status_code)
+                flow.response = http.HTTPResponse.make(status_code, msg)
+                return None
+        # Invocations ended early (throttled, cancelled...) give no verdict
+        invoked = False
+        try:
+            try:
+                (invoke, event) = self.get_invoke(
+                    invocation.func_name, invocation.event_type, request, response
+                )
+            except Exception as e:
+                self.invocation_exception(flow, invocation, e)
+                return None
+            invocation.mark("serialize")
+            limiter = self.limiters.get(invocation.func_name)
+            if limiter:
+                reason = await limiter.acquire(ctx.options.lambda_at_edge_throttle_wait)
+                invocation.mark("throttle")
+                if reason:
+                    # CloudFront responds 503 when the function is throttled
+                    msg = f"Lambda@Edge: throttled by the {reason} limit"
+                    ctx.log.warn(msg)
+                    invocation.error(f"{reason}_throttled", 503)
+                    flow.response = http.HTTPResponse.make(503, msg)
+                    return None
+            capture = self.profile_capture
+            if capture and capture.flow is flow:
+                invoke = capture.wrap(invoke)
+            invocation.start = self.containers.acquire(invocation.func_name)
+            try:
+                loop = asyncio.get_event_loop()
+                (res, payload_raw, times) = await loop.run_in_executor(
+                    self.executor,
+                    invoke,
+                    invocation.func_name,
+                    event,
+                    invocation.event_type,
+                    invocation.start == "cold",
+                )
+                invoked = True
+                invocation.mark("queue", times[0])
+                invocation.mark("invoke", times[1])
+                invocation.mark("read", times[2])
+                self.metrics.observe(
+                    "lambda_at_edge_invoke_seconds",
+                    invocation.labels + (("start", invocation.start),),
+                    times[1] - times[0],
+                )
+                if res["StatusCode"] != 200:
+                    msg = "Lambda@Edge StatusCode: " + str(res["StatusCode"])
+                    ctx.log.error(msg)
+                    invocation.error("status_code", 502)
+                    flow.response = http.HTTPResponse.make(502, msg)
+                    return None
+                if payload_raw is None or payload_raw == b"":
+                    msg = f"Lambda@Edge: no payload"
+                    ctx.log.warn(msg)
+                    invocation.error("no_payload", 502)
+                    flow.response = http.HTTPResponse.make(502, msg)
+                    return None
+                try:
+                    if isinstance(payload_raw, bytes):
+                        payload = json_loads(payload_raw)
+                    else:
+                        payload = payload_raw
+                except json.decoder.JSONDecodeError as e:
+                    # If payload_raw starts with b'Task timed out after
+                    # then it's a timeout error - error 503
+                    msg = f"Lambda@Edge non-JSON payload: '{payload_raw}'"
+                    ctx.log.warn(msg)
+                    invocation.error("non_json_payload", 503)
+                    flow.response = http.HTTPResponse.make(503, msg)
+                    return None
+                invocation.mark("parse")
+                if ctx.options.lambda_at_edge_emulate_limits and not self.check_quotas(
+                    flow, invocation, payload_raw, payload, times[1] - times[0]
+                ):
+                    return None
+                if "FunctionError" in res:
+                    msg = f"Lambda@Edge FunctionError: '{res['FunctionError']}'\n'{payload}'"
+                    ctx.log.warn(msg)
+                    invocation.error("function_error", 503)
+                    flow.response = http.HTTPResponse.make(503, msg)
+                    return None
+                if not isinstance(payload, dict):
+                    msg = f"Lambda@Edge: malformed payload '{payload}'"
+                    ctx.log.warn(msg)
+                    invocation.error("malformed_payload", 502)
+                    flow.response = http.HTTPResponse.make(502, msg)
+                    return None
+                return payload
+            except (
+                botocore.exceptions.ReadTimeoutError,
+                botocore.exceptions.ClientError,
+                ConnectionRefusedError,
+                botocore.exceptions.EndpointConnectionError,
+            ) as e:
+                invoked = True
+                msg = f"Lambda@Edge: Exception: {repr(e)}"
+                ctx.log.warn(msg)
+                # Lambda throttling is a 503 for CloudFront
+                status_code = (
+                    503
+                    if isinstance(e, botocore.exceptions.ClientError)
+                    and e.response.get("Error", {}).get("Code")
+                    == "TooManyRequestsException"
+                    else 502
+                )
+                error = type(e).__name__
+                if (
+                    isinstance(e, botocore.exceptions.ReadTimeoutError)
+                    and ctx.options.lambda_at_edge_emulate_limits
+                ):
+                    # The read timeout is the function timeout: 503 for CloudFront
+                    (error, status_code) = ("limit_timeout", 503)
+                invocation.error(error, status_code)
+                flow.response = http.HTTPResponse.make(status_code, msg)
+            except Exception as e:
+                invoked = True
+                self.invocation_exception(flow, invocation, e)
+            finally:
+                self.containers.release(invocation.func_name)
+                if limiter:
+                    limiter.release()
+        finally:
+            if breaker:
+                failed = invocation.failure in BREAKER_ERRORS if invoked else None
+                self.end_breaker(invocation, breaker, token, failed)
+        return None
 
 
 addons = [LambdaEdgeLocalProxy()]
+
+
+if __name__ == "__main__" and sys.argv[1:] == [PYTHON_WORKER_ARG]:
+    python_worker()